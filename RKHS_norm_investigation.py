@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 import tikzplotlib
 import pickle
-from scipy.special import comb
+from scenario_approach import scenario_approach_index, scenario_approach_bound
 import matplotlib.cm as cm
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
@@ -124,16 +124,7 @@ def PAC_RKHS_norm_NeurIPS_numerical_investigation(X_plot, X_sample, Y_sample, N_
         list_random_RKHS_norms.append(random_RKHS_norm)
     numpy_list = [tensor.item() for tensor in list_random_RKHS_norms]
     numpy_list.sort()
-    r_final = 0
-    for r in range(m_PAC):  # you can compute this a priori
-        summ = 0
-        for i in range(r):
-            summ += comb(m_PAC, i)*gamma_PAC**(i)*(1-gamma_PAC)**(m_PAC-i)
-        if summ > kappa_PAC or B > numpy_list[-1-r]:
-            break
-        else:
-            r_final = r
-    B = max(B, numpy_list[-1-r_final])
+    B = scenario_approach_bound(B, numpy_list, scenario_approach_index(m_PAC, gamma_PAC, kappa_PAC))
     B = min(B, old_B)
     return B
 
@@ -214,13 +205,7 @@ def compare_PAC_RKHS_norm_SysDO_NeurIPS(X_plot, X_sample, Y_sample, N_hat, kerne
     b_Hoeffding = maximum_possible_RKHS_norm.detach().numpy()
     a_Hoeffding = minimum_possible_RKHS_norm.detach().numpy()
     B_SysDO = np.mean(numpy_list) + np.sqrt(np.log(1/gamma)*(b_Hoeffding-a_Hoeffding)**2/(2*m))
-    for r in range(m_PAC):  # you can compute this a priori
-        summ = 0
-        for i in range(r):
-            summ += comb(m_PAC, i)*gamma_PAC**(i)*(1-gamma_PAC)**(m_PAC-i)
-        if summ > kappa:
-            break
-    r_final = r - 1 if r > 0 else r
+    r_final = scenario_approach_index(m, gamma, kappa)
     B_NeurIPS = numpy_list[-1-r_final]
     return B_SysDO, B_NeurIPS
 
@@ -246,13 +231,7 @@ def scenario_approach_time(X_plot, X_sample, inverse_matrix, Y_sample, N_hat, ke
 
     numpy_list = [tensor.item() for tensor in list_random_RKHS_norms]
     numpy_list.sort()  # sorted RKHS norms
-    for r in range(m_PAC):  # you can compute this a priori
-        summ = 0
-        for i in range(r):
-            summ += comb(m_PAC, i)*gamma_PAC**(i)*(1-gamma_PAC)**(m_PAC-i)
-        if summ > kappa_PAC:
-            break
-    r_final = r - 1 if r > 0 else r
+    r_final = scenario_approach_index(m, gamma_PAC, kappa_PAC)
     time_required = time.time() - current_time  # total time needed
     return time_required
 
@@ -442,15 +421,7 @@ if __name__ == '__main__':
         #           1800, 1900, 2000, 2100, 2200, 2300, 2400, 2500, 2600, 2700, 2800, 2900, 3000]
         m_list = [x*500 for x in range(1, 15)]
         for m in tqdm(m_list):
-            for r in range(m):  # try different r
-                summ = 0  # now r is fixed
-                for i in range(r+1):  # compute the sum over r
-                    summ += comb(m, i)*gamma**(i)*(1-gamma)**(m-i)
-                if summ > kappa:
-                    break
-                # else:
-                #     r_final = r
-            list_r.append(r-1 if r > 0 else 0)
+            list_r.append(max(scenario_approach_index(m, gamma, kappa) - 1, 0))
         plt.figure()
         plt.plot(m_list, list_r)
         plt.xlabel('m')
@@ -463,15 +434,7 @@ if __name__ == '__main__':
         list_r = []
         list_gamma = [0.001*x for x in range(1, 100)]
         for gamma in list_gamma:
-            for r in range(m):  # try different r
-                summ = 0  # now r is fixed
-                for i in range(r+1):  # compute the sum over r
-                    summ += comb(m, i)*gamma**(i)*(1-gamma)**(m-i)
-                if summ > kappa:
-                    break
-                # else:
-                #     r_final = r
-            list_r.append(r-1 if r > 0 else 0)
+            list_r.append(max(scenario_approach_index(m, gamma, kappa) - 1, 0))
         plt.figure()
         plt.plot(list_gamma, list_r)
         plt.xlabel('gamma')
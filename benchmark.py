@@ -0,0 +1,128 @@
+'''
+Benchmark of run() for SafeOpt and ours on synthetic ground truths with fixed seeds.
+The dimension/resolution pairs are the ones used in the experiments (see points_per_axis in main.py).
+Every (configuration, run type) is executed in a fresh process, so that the peak memory belongs to that run only.
+Writes one JSON file with wall time per iteration, time per stage and peak memory, e.g., to compare two commits:
+    python benchmark.py --configurations 1D_1000 2D_500 --num_iterations 10 --output benchmark.json
+'''
+
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+import torch
+import gpytorch
+
+
+configurations = {'1D_1000': (1, 1000), '2D_500': (2, 500), '3D_100': (3, 100), '4D_30': (4, 30), '6D_8': (6, 8)}  # name: (n_dimensions, points_per_axis)
+run_types = ['SafeOpt', 'ours']
+
+# Hyperparameters as in the numerical experiments of main.py
+noise_std = 0.01
+delta_confidence = 0.01
+exploration_threshold = 0.1
+delta_cube = 0.1
+num_local_cubes = 5
+num_safe_points = 1
+num_center_points = 1000
+RKHS_norm = 5
+alpha_bar = 1
+m_PAC = 1000
+gamma_PAC = 0.1
+kappa_PAC = 0.01
+
+
+def run_benchmark(configuration, run_type, num_iterations, seed):
+    import main  # imported here, so that the parent process stays small
+    from lattice import lattice
+    n_dimensions, points_per_axis = configurations[configuration]
+    # run() and its helpers read these from the module, as when main.py is executed as a script
+    main.Furuta = False
+    main.n_dimensions = n_dimensions
+    main.noise_std = noise_std
+    main.num_safe_points = num_safe_points
+    main.gamma_PAC = gamma_PAC
+    main.kappa_PAC = kappa_PAC
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    start = time.perf_counter()
+    X_lattice = lattice(n_dimensions, points_per_axis)
+    main.X_plot = X_lattice.points()  # one copy of the full grid, shared with the global cube of run()
+    gt = main.ground_truth(num_center_points=num_center_points, X_plot=main.X_plot, RKHS_norm=RKHS_norm)
+    X_sample, Y_sample = main.initial_safe_samples(gt=gt, num_safe_points=num_safe_points)
+    ground_truth_time = time.perf_counter() - start
+    if run_type == 'SafeOpt':
+        hyperparameters = [noise_std, delta_confidence, exploration_threshold, RKHS_norm, False, run_type]
+        args = [hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, True, None, False, False]
+    else:
+        hyperparameters = [noise_std, delta_confidence, alpha_bar, m_PAC, gamma_PAC, kappa_PAC, exploration_threshold, delta_cube, num_local_cubes, run_type]
+        RNN_model = main.load_model(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rnn_model.pt'), hidden_size=20, num_layers=2, num_classes=1)
+        args = [hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, False, RNN_model, True, False]
+    error = None
+    main.profiling.enable()  # the stages of main.py, as in a profiled run
+    with torch.no_grad(), gpytorch.settings.fast_pred_var():
+        start = time.perf_counter()
+        try:
+            main.run(args=args)
+        except Exception as exception:  # e.g., an unsafe sample in ours; the timings up to here are still reported
+            error = repr(exception)
+        total_time = time.perf_counter() - start
+    main.profiling.disable()
+    stages = main.profiling.summary()  # times are inclusive, e.g., 'compute_confidence_intervals_evaluation' contains 'PAC sampling'
+    iteration_times = [event['duration'] for event in main.profiling.events if event['kind'] == 'span' and event['name'] == 'iteration']
+    return {'configuration': configuration, 'run_type': run_type, 'n_dimensions': n_dimensions, 'points_per_axis': points_per_axis,
+            'num_iterations': num_iterations, 'seed': seed, 'num_threads': torch.get_num_threads(), 'ground_truth_time': ground_truth_time,
+            'total_time': total_time, 'num_experiments': stages.get('conduct_experiment', {}).get('calls', 0), 'iteration_times': iteration_times,
+            'stage_times': {name: stage['time'] for name, stage in stages.items()}, 'stage_calls': {name: stage['calls'] for name, stage in stages.items()},
+            'peak_memory_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024, 'error': error}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--configurations', nargs='+', default=list(configurations), choices=list(configurations))
+    parser.add_argument('--run_types', nargs='+', default=run_types, choices=run_types)
+    parser.add_argument('--num_iterations', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--num_threads', type=int, default=None)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--worker', nargs=2, metavar=('CONFIGURATION', 'RUN_TYPE'), help=argparse.SUPPRESS)  # one run in this process
+    arguments = parser.parse_args()
+    if arguments.num_threads is not None:
+        torch.set_num_threads(arguments.num_threads)
+
+    if arguments.worker is not None:
+        result = run_benchmark(*arguments.worker, num_iterations=arguments.num_iterations, seed=arguments.seed)
+        print(json.dumps(result))  # last line of the output is read by the parent
+        sys.exit(0)
+
+    results = []
+    for configuration in arguments.configurations:
+        for run_type in arguments.run_types:
+            command = [sys.executable, os.path.abspath(__file__), '--worker', configuration, run_type,
+                       '--num_iterations', str(arguments.num_iterations), '--seed', str(arguments.seed)]
+            if arguments.num_threads is not None:
+                command += ['--num_threads', str(arguments.num_threads)]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            lines = completed.stdout.strip().splitlines()
+            if completed.returncode != 0 or not lines:
+                result = {'configuration': configuration, 'run_type': run_type, 'error': completed.stderr.strip().splitlines()[-1:]}
+            else:
+                result = json.loads(lines[-1])
+            results.append(result)
+            print(f"{configuration} {run_type}: {result.get('total_time', float('nan')):.2f}s for {result.get('num_experiments', 0)} experiments, "
+                  f"peak memory {result.get('peak_memory_bytes', 0)/2**20:.0f} MB" + (f", error {result['error']}" if result.get('error') else ''))
+    with open(arguments.output, 'w') as handle:
+        json.dump({'commit': git_commit(), 'torch': torch.__version__, 'results': results}, handle, indent=1)
@@ -0,0 +1,81 @@
+import os
+import threading
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+import numpy as np
+import torch
+
+
+worker_ground_truth = None  # the ground truth of a worker process; constructed once and reused for all of its episodes
+
+
+def initialize_worker(make_ground_truth, num_threads):
+    global worker_ground_truth
+    torch.set_num_threads(num_threads)  # the workers share the cores
+    worker_ground_truth = make_ground_truth()
+
+
+def run_episode(x, noise_std, seed):
+    np.random.seed(seed)  # each episode is reproducible and independent of the worker it runs on
+    torch.manual_seed(seed)
+    return worker_ground_truth.conduct_experiment(x=x, noise_std=noise_std)
+
+
+def call_worker(name, args, kwargs):  # any other method or attribute of the ground truth, e.g., initial_safe_samples
+    attribute = getattr(worker_ground_truth, name)
+    return attribute(*args, **kwargs) if callable(attribute) else attribute
+
+
+class experiment_pool():
+    '''
+    Process pool in front of an expensive ground truth, e.g., ground_truth_experiment for Gym or ground_truth_Furuta in the simulator.
+    Every worker builds its own ground truth (and thus its environments) once with make_ground_truth, which has to be picklable
+    unless the context is 'fork'. conduct_experiment runs num_episodes rollouts of the same parameter in parallel and returns their mean,
+    so an experiment costs one rollout instead of environment start-up plus num_episodes serial rollouts.
+    The noise of the mean is smaller than the one of a single rollout; keeping noise_std of the GP as it is stays conservative.
+    submit returns a concurrent.futures.Future, so several experiments can be in flight at once (asyncio.wrap_future makes it awaitable).
+    '''
+    def __init__(self, make_ground_truth, num_workers=None, num_episodes=1, context='spawn'):
+        self.num_workers = num_workers or os.cpu_count()
+        self.num_episodes = num_episodes
+        self.executor = ProcessPoolExecutor(max_workers=self.num_workers, mp_context=multiprocessing.get_context(context), initializer=initialize_worker,
+                                            initargs=(make_ground_truth, max(1, torch.get_num_threads() // self.num_workers)))
+        self.safety_threshold = self.call('safety_threshold')  # read by run()
+
+    def call(self, name, *args, **kwargs):
+        return self.executor.submit(call_worker, name, args, kwargs).result()
+
+    def initial_safe_samples(self, *args, **kwargs):
+        return self.call('initial_safe_samples', *args, **kwargs)
+
+    def submit(self, x, noise_std=None):
+        future = Future()
+        seeds = np.random.randint(0, 2**31 - 1, size=self.num_episodes).tolist()  # drawn here, so that runs stay reproducible with np.random.seed
+        episodes = [self.executor.submit(run_episode, x, noise_std, seed) for seed in seeds]
+        remaining = [len(episodes)]
+        lock = threading.Lock()
+
+        def episode_done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                future.set_result(torch.mean(torch.stack([episode.result() for episode in episodes]), dim=0))
+            except Exception as exception:  # e.g., a crashed environment; raised by future.result()
+                future.set_exception(exception)
+        for episode in episodes:
+            episode.add_done_callback(episode_done)
+        return future
+
+    def conduct_experiment(self, x, noise_std=None):
+        return self.submit(x, noise_std=noise_std).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,74 @@
+import math
+import torch
+
+
+class lattice():
+    '''
+    Regular grid on [0, 1]^n_dimensions with points_per_axis points per axis that is never materialized as a whole.
+    Point j has the same coordinates and the same (row-major) position as row j of compute_X_plot(n_dimensions, points_per_axis),
+    so boxes [lb, ub] are turned into index ranges per axis instead of scanning all points_per_axis**n_dimensions points.
+    '''
+    def __init__(self, n_dimensions, points_per_axis):
+        self.n_dimensions = n_dimensions
+        self.points_per_axis = points_per_axis
+        self.axis = torch.linspace(0, 1, points_per_axis)  # identical to the axis of compute_X_plot
+        self.shape = torch.Size([points_per_axis**n_dimensions, n_dimensions])  # as if it was the full X_plot tensor
+        self.all_points = None  # the full grid, once something needed it
+
+    def __getstate__(self):  # e.g., in the tasks of the training pool; the full grid is rebuilt where it is needed instead of being sent along
+        return dict(self.__dict__, all_points=None)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def coordinates(self, flat_indices, ranges=None):  # points at flat indices of the full grid, or of the sub-grid given by per-axis ranges
+        if ranges is None:
+            ranges = [(0, self.points_per_axis)]*self.n_dimensions
+        flat_indices = torch.as_tensor(flat_indices, dtype=torch.int64).reshape(-1)
+        X = torch.empty(flat_indices.shape[0], self.n_dimensions, dtype=self.axis.dtype)
+        for d in reversed(range(self.n_dimensions)):  # last axis varies fastest, as in torch.cartesian_prod
+            start, stop = ranges[d]
+            X[:, d] = self.axis[start + flat_indices % (stop - start)]
+            flat_indices = flat_indices // (stop - start)
+        return X
+
+    def __getitem__(self, indices):  # flat indices, boolean masks over all points or slices, like indexing the X_plot tensor
+        if isinstance(indices, slice):
+            return self.coordinates(torch.arange(len(self))[indices])
+        indices = torch.as_tensor(indices)
+        if indices.dtype == torch.bool:
+            indices = torch.nonzero(indices).flatten()
+        return self.coordinates(indices)
+
+    def box_ranges(self, lb, ub):  # per axis [start, stop) of the grid points with lb <= x <= ub
+        ranges = []
+        for d in range(self.n_dimensions):
+            start = int(torch.searchsorted(self.axis, torch.as_tensor(lb[d], dtype=self.axis.dtype).reshape(1), right=False))
+            stop = int(torch.searchsorted(self.axis, torch.as_tensor(ub[d], dtype=self.axis.dtype).reshape(1), right=True))
+            ranges.append((start, max(start, stop)))
+        return ranges
+
+    def box_size(self, lb, ub):
+        return math.prod(stop - start for start, stop in self.box_ranges(lb, ub))
+
+    def box(self, lb, ub):  # same points and order as X_plot[torch.all(torch.logical_and(X_plot >= lb, X_plot <= ub), axis=1)]
+        ranges = self.box_ranges(lb, ub)
+        return self.coordinates(torch.arange(math.prod(stop - start for start, stop in ranges)), ranges)
+
+    def box_flat_indices(self, lb, ub):  # indices of the box points in the full grid, e.g., to index gt.fX
+        ranges = self.box_ranges(lb, ub)
+        flat_indices = torch.zeros(1, dtype=torch.int64)
+        for start, stop in ranges:
+            flat_indices = (flat_indices.unsqueeze(1)*self.points_per_axis + torch.arange(start, stop).unsqueeze(0)).reshape(-1)
+        return flat_indices
+
+    def chunks(self, chunk_size, lb=None, ub=None):  # points of the whole grid or of the box [lb, ub], chunk_size at a time
+        ranges = self.box_ranges(lb, ub) if lb is not None else [(0, self.points_per_axis)]*self.n_dimensions
+        num_points = math.prod(stop - start for start, stop in ranges)
+        for start in range(0, num_points, chunk_size):
+            yield self.coordinates(torch.arange(start, min(start + chunk_size, num_points)), ranges)
+
+    def points(self):  # the full grid; only for things that need all of it anyway (ground truth, global cube, plots). Shared, do not modify
+        if self.all_points is None:
+            self.all_points = self.coordinates(torch.arange(len(self)))
+        return self.all_points
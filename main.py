@@ -25,12 +25,22 @@ import pickle
 import dill
 from matplotlib.patches import Ellipse
 import torch.multiprocessing as mp
-from scipy.special import comb
+from scipy.spatial import cKDTree
+from scenario_approach import scenario_RKHS_norms, scenario_approach_index, scenario_approach_bound, PAC_memory_budget
+from training_data import sequence_store
+from lattice import lattice
+from profiler import profiler
+from experiment_pool import experiment_pool
 from plot import plot_1D, plot_2D_contour, plot_1D_SafeOpt_with_sets, plot_gym, plot_gym_together
 from ground_truth_experiment import ground_truth_experiment
 import gym
 import sys
 import os
+import hashlib
+import tempfile
+import functools
+from contextlib import nullcontext
+from collections import OrderedDict
 
 # Uncomment the following and clone repo https://git.rwth-aachen.de/quanser-vision/vision-based-furuta-pendulum to conduct Furuta pendulum experiments
 
@@ -40,6 +50,8 @@ import os
 # warnings.filterwarnings("ignore", category=np.VisibleDeprecationWarning)
 # from IPython import embed as IPS
 
+profiling = profiler()  # opt-in: profiling.enable() (memory=True for tensor and RSS peaks) before run(), then profiling.export_chrome_trace(path), export_jsonl(path) or summary()
+
 
 class MultiLayerRNN(nn.Module):
     def __init__(self, hidden_size, num_layers, num_classes):
@@ -61,7 +73,7 @@ class MultiLayerRNN(nn.Module):
         # Forward pass for the second input branch
         out2, _ = self.rnn2(x2)
         # Concatenate the outputs of both branches
-        out = torch.cat((out1, out2), dim=1)
+        out = torch.cat((out1, out2), dim=-1)  # last dimension, so that batched inputs work as well
         # Merge layer
         out = self.merge_layer(out)
         # Output layer
@@ -73,13 +85,54 @@ def load_model(model_path, hidden_size, num_layers, num_classes):
     model = MultiLayerRNN(hidden_size=hidden_size, num_layers=num_layers, num_classes=num_classes)
     model.load_state_dict(torch.load(model_path))
     return model
-def predict(model, input1, input2):
-    model.eval()
-    input1_tensor = torch.tensor(input1).unsqueeze(0)
-    input2_tensor = torch.tensor(input2).unsqueeze(0)
-    with torch.no_grad():
-        output = model(input1_tensor, input2_tensor)
-    return output.item()
+
+
+class RNN_state_cache():
+    '''
+    Predicts the RKHS norms of several cubes in one forward pass. The RNN sees the zero-padded history of a cube as one time step
+    with 50 features, as in sequence_store.batches(), and the history of a cube only grows by one element when a new sample lands in it.
+    The gate pre-activations of the first LSTM layer are linear in the input, so they are cached per cube and branch and only the columns
+    of the new elements are added.
+    The layers above and the output layers are evaluated for all cubes at once; their cost does not depend on the length of the history.
+    '''
+    def __init__(self):
+        self.model = None
+        self.states = {}  # (cube tuple, branch) -> (number of elements included, gate pre-activations of the first layer)
+
+    def clear(self):
+        self.model = None
+        self.states.clear()
+
+    def first_layer_preactivation(self, rnn, key, values):
+        values = [float(value) for value in values][:rnn.input_size]  # everything beyond the input size is cut
+        num_included, preactivation = self.states.get(key, (0, rnn.bias_ih_l0 + rnn.bias_hh_l0))  # h and c start at zero
+        if num_included > len(values):  # not an extension of the cached history; start over
+            num_included, preactivation = 0, rnn.bias_ih_l0 + rnn.bias_hh_l0
+        if len(values) > num_included:
+            preactivation = preactivation + rnn.weight_ih_l0[:, num_included:len(values)] @ torch.tensor(values[num_included:])
+        self.states[key] = (len(values), preactivation)
+        return preactivation
+
+    def lstm_output(self, rnn, preactivation):  # one time step from zero states; preactivation holds the gates of the first layer
+        for layer in range(rnn.num_layers):
+            if layer > 0:
+                preactivation = h @ getattr(rnn, f'weight_ih_l{layer}').T + getattr(rnn, f'bias_ih_l{layer}') + getattr(rnn, f'bias_hh_l{layer}')
+            i, f, g, o = preactivation.chunk(4, dim=-1)  # the forget gate does not matter, since c starts at zero
+            h = torch.sigmoid(o)*torch.tanh(torch.sigmoid(i)*torch.tanh(g))
+        return h
+
+    @profiling.profiled('RNN predict')
+    def predict_batch(self, model, keys, inputs1, inputs2):
+        if model is not self.model:  # cached pre-activations belong to one model
+            self.clear()
+            self.model = model
+        model.eval()
+        with torch.no_grad():
+            preactivation1 = torch.stack([self.first_layer_preactivation(model.rnn1, (key, 1), input1) for key, input1 in zip(keys, inputs1)])
+            preactivation2 = torch.stack([self.first_layer_preactivation(model.rnn2, (key, 2), input2) for key, input2 in zip(keys, inputs2)])
+            out = torch.cat((self.lstm_output(model.rnn1, preactivation1), self.lstm_output(model.rnn2, preactivation2)), dim=-1)
+            output = model.fc(model.merge_layer(out))
+        return output.flatten().tolist()
 
 
 
@@ -121,6 +174,121 @@ def convert_to_hashable(item):
         return item
 
 
+def jittered_cholesky(K, nugget):
+    # Cholesky factor of K + nugget*I; the nugget is only increased if the factorization fails
+    while True:
+        L, info = torch.linalg.cholesky_ex(K + torch.eye(K.shape[0], dtype=K.dtype)*nugget)
+        if info == 0:
+            return L, nugget
+        nugget *= 10
+
+
+def extend_cholesky(L, k_new, k_new_new):
+    # Rank-one update in O(n^2): factor of [[A, k_new], [k_new^T, k_new_new]] from the factor L of A
+    l_new = torch.linalg.solve_triangular(L, k_new, upper=False)
+    d_squared = k_new_new - l_new.T @ l_new
+    if not d_squared > 0:  # numerically not positive definite anymore; refactor from scratch
+        return None
+    n = L.shape[0]
+    L_extended = torch.zeros(n + 1, n + 1, dtype=L.dtype)
+    L_extended[:n, :n] = L
+    L_extended[n, :n] = l_new.flatten()
+    L_extended[n, n] = torch.sqrt(d_squared).flatten()
+    return L_extended
+
+
+class gram_factor_cache():
+    # Cholesky factors of kernel(X, X) + nugget*I, shared by all call sites that used to invert the same Gram matrix.
+    # Samples are only ever appended, so a missing factor is extended from the factor of X[:-1] whenever possible.
+    def __init__(self):
+        self.factors = {}
+        self.used = set()
+
+    def key(self, kernel, X, nugget):
+        return (tuple(X.shape), X.detach().numpy().tobytes(), kernel.lengthscale.detach().numpy().tobytes(), float(nugget))
+
+    def cholesky(self, kernel, X, nugget, store=True):
+        key = self.key(kernel, X, nugget)
+        if key in self.factors:
+            self.used.add(key)
+            return self.factors[key][0]
+        L = None
+        if store and X.shape[0] > 1:
+            prefix_key = self.key(kernel, X[:-1], nugget)
+            if prefix_key in self.factors:
+                L_prefix, nugget_used = self.factors[prefix_key]
+                L = extend_cholesky(L_prefix, kernel(X[:-1], X[-1:]).evaluate(), kernel(X[-1:], X[-1:]).evaluate() + nugget_used)
+        if L is None:
+            L, nugget_used = jittered_cholesky(kernel(X, X).evaluate(), nugget)
+        if store:  # large one-off matrices (e.g., ground truth labels) are not kept
+            self.factors[key] = (L, nugget_used)
+            self.used.add(key)
+        return L
+
+    def solve(self, kernel, X, nugget, rhs, store=True):  # (kernel(X, X) + nugget*I)^{-1} @ rhs
+        return torch.cholesky_solve(rhs, self.cholesky(kernel, X, nugget, store=store))
+
+    def logdet(self, kernel, X, nugget):  # log det(kernel(X, X) + nugget*I) in O(n) from the cached factor
+        return 2*torch.sum(torch.log(torch.diagonal(self.cholesky(kernel, X, nugget))))
+
+    def new_iteration(self):  # keep only factors used in the last iteration; they are the prefixes of the next ones
+        self.factors = {key: self.factors[key] for key in self.used}
+        self.used = set()
+
+    def clear(self):
+        self.factors.clear()
+        self.used.clear()
+
+
+class model_cache():
+    # Fitted GP models of the cubes (and their Gram matrices), keyed by the bitmask of the rows of X_sample they are trained on.
+    # X_sample only grows within one run, so a key stands for the same samples in all iterations. Least recently used models are dropped.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.models = OrderedDict()
+
+    def get(self, key):
+        if key not in self.models:
+            return None
+        self.models.move_to_end(key)
+        return self.models[key]
+
+    def put(self, key, value):
+        self.models[key] = value
+        self.models.move_to_end(key)
+        while len(self.models) > self.maxsize:
+            self.models.popitem(last=False)
+
+    def clear(self):
+        self.models.clear()
+
+
+def sample_bitmask(sample_indices):  # rows of X_sample as the bits of an integer; trailing rows that are not used do not change it
+    return int.from_bytes(np.packbits(sample_indices.numpy(), bitorder='little').tobytes(), 'little')
+
+
+gram_factors = gram_factor_cache()  # cleared at the start of run()
+GP_models = model_cache(maxsize=256)  # cleared at the start of run()
+RNN_states = RNN_state_cache()  # cleared at the start of run()
+batch_size_q = 1  # experiments per round; > 1 proposes up to this many separated candidates, each one from a cube with PAC bounds (ours)
+batch_separation = 0.01  # minimum distance (max-norm) between the candidates of one round and to earlier samples
+batch_parallel = True  # conduct the experiments of one round in a process pool; the ground truth is inherited by fork
+batch_context = {}  # ground truth and noise for the worker processes of the batch pool
+checkpoint_path = None  # file to which run() saves its complete state after every experiment; continue with resume(args, checkpoint_path). Training tasks use one file per task
+checkpoint_version = 3  # increased whenever the content of the checkpoints changes
+checkpoint_bit_identical = False  # also save the Cholesky factors (and the ground truth in training), so that a resumed run is bit-identical; larger and slower checkpoints
+posterior_memory_budget = 2**28  # bytes for one chunk of cross-covariances in safe_BO.compute_mean_var (256 MB)
+label_max_points = 10000  # larger boxes are subsampled for the local RKHS norm labels
+gt_memory_budget = 2**28  # bytes for one chunk of kernel(X, X_center) when evaluating the ground truth (256 MB)
+gt_float64 = False  # evaluate the ground truth in double precision; fX is stored as float32 in any case
+gt_cache_dir = None  # directory for memory-mapped fX files, so that the same function on the same grid is evaluated only once
+adaptive_levels = 0  # > 0: refine the grid of each cube this many times (halving the spacing) at the safe set boundary and at potential maximizers
+expander_strategy = 'auto'  # 'auto', 'nearest', 'dense', 'chunked' or 'per_point'; see safe_BO.choose_expander_strategy
+expander_memory_budget = 2**28  # bytes for one block of kernel distances between potential expanders and unsafe points (256 MB)
+radial_kernels = ('MaternKernel', 'RBFKernel')  # kernels that decrease with the Euclidean distance after dividing by the lengthscale; needed for 'nearest'
+expander_per_point_max = 8  # with at most this many potential expanders, each one gets the whole budget and stops at its first unsafe point
+
+
 def compute_X_plot(n_dimensions, points_per_axis):
     X_plot_per_domain = torch.linspace(0, 1, points_per_axis)
     X_plot_per_domain_nd = [X_plot_per_domain] * n_dimensions
@@ -140,11 +308,18 @@ def initial_safe_samples(gt, num_safe_points):  # for toy examples and introduct
 
 
 class ground_truth():
+    @profiling.profiled('ground_truth.__init__')
     def __init__(self, num_center_points, X_plot, RKHS_norm):
         def fun(kernel, alpha):
-            return lambda X: kernel(X.reshape(-1, self.X_center.shape[1]), self.X_center).detach().numpy() @ alpha
+            def f(X):  # chunks of X, so that kernel(X, X_center) never exceeds gt_memory_budget
+                X = X.reshape(-1, self.X_center.shape[1])
+                dtype = torch.float64 if gt_float64 else X.dtype
+                chunk_size = max(1, gt_memory_budget // (torch.finfo(dtype).bits//8*self.X_center.shape[0]))
+                return np.concatenate([kernel(X[start:start+chunk_size].to(dtype), self.X_center.to(dtype)).detach().numpy() @ alpha
+                                       for start in range(0, max(X.shape[0], 1), chunk_size)])
+            return f
         # For ground truth
-        self.X_plot = X_plot
+        self.X_plot = X_plot.points() if isinstance(X_plot, lattice) else X_plot  # fX is needed on the whole grid
         self.RKHS_norm = RKHS_norm
         random_indices_center = torch.randint(high=self.X_plot.shape[0], size=(num_center_points,))
         self.X_center = self.X_plot[random_indices_center]
@@ -154,43 +329,152 @@ class ground_truth():
         RKHS_norm_squared = alpha.T @ self.kernel(self.X_center, self.X_center).detach().numpy() @ alpha
         alpha /= np.sqrt(RKHS_norm_squared)/RKHS_norm  # scale to RKHS norm
         self.f = fun(self.kernel, alpha)
-        self.fX = torch.tensor(self.f(self.X_plot), dtype=torch.float32)
+        self.fX = self.compute_fX(alpha)
         self.safety_threshold = np.quantile(self.fX, 0.3)  # np.quantile(self.fX, np.random.uniform(low=0.15, high=0.5))  # alternative option
-
+        self.local_RKHS_norms = {}  # training labels per box
+        self.nested_factors = {}  # per center of nested boxes: shell-ordered points, Cholesky factor and forward solution; see nested_local_RKHS_norm
+        self.nested_finished = set()  # centers whose factor was dropped; only their labels are kept
+        self.num_nested_boxes = None  # boxes per center (num_local_cubes); a factor with that many boxes is not extended anymore
+
+    def compute_fX(self, alpha):
+        if gt_cache_dir is None:
+            return torch.tensor(self.f(self.X_plot), dtype=torch.float32)
+        key = hashlib.sha1()
+        for item in [self.X_center.numpy(), alpha, self.kernel.lengthscale.detach().numpy(), np.asarray(self.X_plot.shape), self.X_plot.numpy(), np.asarray(gt_float64)]:
+            key.update(np.ascontiguousarray(item).tobytes())
+        path = os.path.join(gt_cache_dir, f'fX_{key.hexdigest()}.f32')
+        if not os.path.exists(path):  # evaluate chunk by chunk into the file; renamed only once it is complete
+            os.makedirs(gt_cache_dir, exist_ok=True)
+            handle, tmp_path = tempfile.mkstemp(dir=gt_cache_dir, prefix=os.path.basename(path) + '.', suffix='.tmp')  # unique per process
+            os.close(handle)
+            try:
+                fX = np.memmap(tmp_path, dtype=np.float32, mode='w+', shape=(self.X_plot.shape[0],))
+                chunk_size = max(1, gt_memory_budget // (8*self.X_center.shape[0]))
+                for start in range(0, self.X_plot.shape[0], chunk_size):
+                    fX[start:start+chunk_size] = self.f(self.X_plot[start:start+chunk_size])
+                fX.flush()
+                del fX
+                os.replace(tmp_path, path)  # if another process was faster, its file with the same content is replaced
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return torch.from_numpy(np.memmap(path, dtype=np.float32, mode='c', shape=(self.X_plot.shape[0],)))  # copy-on-write; read lazily
+
+    @profiling.profiled('conduct_experiment')
     def conduct_experiment(self, x, noise_std):
         return torch.tensor(self.f(x) + np.random.normal(loc=0, scale=noise_std, size=1), dtype=x.dtype)
 
-    def local_RKHS_norm(self, lb, ub, X_plot_local=None):  # needed for getting training labels
+    def box_key(self, lb, ub, local):
+        return (torch.as_tensor(lb, dtype=torch.float32).numpy().tobytes(), torch.as_tensor(ub, dtype=torch.float32).numpy().tobytes(), local)
+
+    @profiling.profiled('local_RKHS_norm')
+    def local_RKHS_norm(self, lb, ub, X_plot_local=None, center=None, radii=None):  # needed for getting training labels
+        '''
+        Labels are cached per box. If the box is one of the nested boxes center +- radii on the grid of the ground truth (X_plot_local is None),
+        all of them share one factorization, see nested_local_RKHS_norm. Otherwise, the box is factorized on its own.
+        '''
+        key = self.box_key(lb, ub, X_plot_local is not None)
+        if key not in self.local_RKHS_norms and X_plot_local is None and center is not None:
+            self.nested_local_RKHS_norm(center, radii)  # also labels the smaller boxes around the same center
+        if key not in self.local_RKHS_norms:
+            self.local_RKHS_norms[key] = self.single_local_RKHS_norm(lb, ub, X_plot_local)
+        return self.local_RKHS_norms[key]
+
+    def nested_local_RKHS_norm(self, center, radii):
+        '''
+        The boxes [center - r, center + r] (clipped) are nested. If the grid points are ordered shell by shell, the Gram matrix of each box
+        is a leading block of the Gram matrix of the largest one, and so are its Cholesky factor and the forward solution z = L^{-1} fX.
+        Hence, the label of box j is the norm of the first n_j entries of z, and a larger box only needs a block extension of the factor.
+        Stops (and leaves the remaining boxes to single_local_RKHS_norm) once a box has more than label_max_points points.
+        The factor is dropped once it cannot be extended anymore, i.e., after that or after num_nested_boxes boxes.
+        '''
+        family_key = (torch.as_tensor(center, dtype=torch.float32).numpy().tobytes(), float(radii[0]))
+        if family_key in self.nested_finished:
+            return
+        if family_key not in self.nested_factors:
+            self.nested_factors[family_key] = {'X': self.X_plot[:0], 'fX': self.fX[:0], 'L': None, 'z': None, 'nugget': 1e-4, 'num_boxes': 0}
+        family = self.nested_factors[family_key]
+        inside_previous = torch.zeros(self.X_plot.shape[0], dtype=torch.bool)
+        for j, radius in enumerate(radii):
+            lb = center - radius
+            ub = center + radius
+            lb[lb < 0] = 0
+            ub[ub > 1] = 1  # clipping, as in safe_BO
+            inside = torch.all(torch.logical_and(self.X_plot >= lb, self.X_plot <= ub), axis=1)
+            if j >= family['num_boxes']:
+                shell = torch.logical_and(inside, ~inside_previous)
+                if family['X'].shape[0] + int(torch.sum(shell)) > label_max_points:
+                    del self.nested_factors[family_key]
+                    self.nested_finished.add(family_key)
+                    return
+                self.extend_nested_factor(family, self.X_plot[shell], self.fX[shell])
+                family['num_boxes'] = j + 1
+                local_RKHS_norm_value = torch.linalg.vector_norm(family['z'][:family['X'].shape[0]]).flatten()
+                if local_RKHS_norm_value > 0:  # otherwise single_local_RKHS_norm increases the nugget
+                    self.local_RKHS_norms.setdefault(self.box_key(lb, ub, False), local_RKHS_norm_value)
+            inside_previous = inside
+        if family['num_boxes'] == self.num_nested_boxes:
+            del self.nested_factors[family_key]
+            self.nested_finished.add(family_key)
+
+    def extend_nested_factor(self, family, X_shell, fX_shell):  # block Cholesky update with the points of the next shell
+        if X_shell.shape[0] == 0:
+            return
+        if family['L'] is None:
+            family['L'], family['nugget'] = jittered_cholesky(self.kernel(X_shell, X_shell).evaluate().detach(), family['nugget'])
+            family['z'] = torch.linalg.solve_triangular(family['L'], fX_shell.reshape(-1, 1), upper=False)
+            family['X'], family['fX'] = X_shell, fX_shell
+            return
+        L_21 = torch.linalg.solve_triangular(family['L'], self.kernel(family['X'], X_shell).evaluate().detach(), upper=False).T
+        schur = self.kernel(X_shell, X_shell).evaluate().detach() + torch.eye(X_shell.shape[0])*family['nugget'] - L_21 @ L_21.T
+        L_22, info = torch.linalg.cholesky_ex(schur)
+        X = torch.cat((family['X'], X_shell))
+        fX = torch.cat((family['fX'], fX_shell))
+        if info == 0:
+            n, m = family['L'].shape[0], X_shell.shape[0]
+            L = torch.zeros(n + m, n + m, dtype=family['L'].dtype)
+            L[:n, :n] = family['L']
+            L[n:, :n] = L_21
+            L[n:, n:] = L_22
+            z_shell = torch.linalg.solve_triangular(L_22, fX_shell.reshape(-1, 1) - L_21 @ family['z'], upper=False)
+            family['L'], family['z'] = L, torch.cat((family['z'], z_shell))
+        else:  # not positive definite anymore; refactor everything with a larger nugget (labels of the smaller boxes are kept)
+            family['L'], family['nugget'] = jittered_cholesky(self.kernel(X, X).evaluate().detach(), family['nugget']*10)
+            family['z'] = torch.linalg.solve_triangular(family['L'], fX.reshape(-1, 1), upper=False)
+        family['X'], family['fX'] = X, fX
+
+    def single_local_RKHS_norm(self, lb, ub, X_plot_local=None):
         nugget_factor = 1e-4  # regularization
         # Returns RKHS norm of ground truth on local domain between lb and ub; heuristic kernel interpolation approach
         if X_plot_local is None:
             local_gt_indices = torch.all(torch.logical_and(self.X_plot >= lb, self.X_plot <= ub), axis=1)
-            if sum(local_gt_indices) > 10000:  # the problem is that the matrix gets very high dimensional and we cannot explicitly compute it
-                subset_boolean = torch.randperm(sum(local_gt_indices)) < 10000
+            if sum(local_gt_indices) > label_max_points:  # the problem is that the matrix gets very high dimensional and we cannot explicitly compute it
+                subset_boolean = torch.randperm(sum(local_gt_indices)) < label_max_points
                 X_local = self.X_plot[local_gt_indices][subset_boolean]
                 fX_local = self.fX[local_gt_indices][subset_boolean]
             else:
                 X_local = self.X_plot[local_gt_indices]
                 fX_local = self.fX[local_gt_indices]
         else:  # use the local X_plots
-            if X_plot.shape[0] > 10000:
-                X_local = X_plot_local[torch.randperm(X_plot_local.shape[0]) < 10000]
+            if X_plot_local.shape[0] > label_max_points:
+                X_local = X_plot_local[torch.randperm(X_plot_local.shape[0]) < label_max_points]
                 fX_local = torch.tensor(self.f(X_local), dtype=X_local.dtype)
             else:
                 X_local = X_plot_local
                 fX_local = torch.tensor(self.f(X_local), dtype=X_local.dtype)
-        K_local = self.kernel(X_local, X_local).evaluate() + torch.eye(X_local.shape[0])*nugget_factor  # add a small nugget factor
-        local_RKHS_norm_value = torch.sqrt(fX_local.reshape(1, -1) @ torch.inverse(K_local) @ fX_local.reshape(-1, 1)).flatten()  # inverse computation takes a lot of time but does not need to be done often. True RKHS norm given eigentlich once. And again also just for training
+        L_local = gram_factors.cholesky(self.kernel, X_local, nugget_factor, store=False)  # add a small nugget factor
+        local_RKHS_norm_value = torch.linalg.vector_norm(torch.linalg.solve_triangular(L_local, fX_local.reshape(-1, 1), upper=False)).flatten()  # factorization takes a lot of time but does not need to be done often. True RKHS norm given eigentlich once. And again also just for training
         while not local_RKHS_norm_value > 0:
             nugget_factor *= 10
-            K_local = self.kernel(X_local, X_local).evaluate() + torch.eye(X_local.shape[0])*nugget_factor  # add a small nugget factor
-            local_RKHS_norm_value = torch.sqrt(fX_local.reshape(1, -1) @ torch.inverse(K_local) @ fX_local.reshape(-1, 1)).flatten()
+            L_local = gram_factors.cholesky(self.kernel, X_local, nugget_factor, store=False)
+            local_RKHS_norm_value = torch.linalg.vector_norm(torch.linalg.solve_triangular(L_local, fX_local.reshape(-1, 1), upper=False)).flatten()
         return local_RKHS_norm_value
 
 
 class safe_BO():
+    @profiling.profiled('safe_BO.__init__')
     def __init__(self, delta_confidence, delta_cube, noise_std, tuple_ik, X_plot, X_sample,
-                Y_sample, safety_threshold, exploration_threshold, gt, compute_local_X_plot, compute_all_sets=False):
+                Y_sample, safety_threshold, exploration_threshold, gt, compute_local_X_plot, compute_all_sets=False, adaptive_levels=0):
         def compute_X_plot_locally(n_dimensions, points_per_axis, lb, ub):  # for scalability; discretization within each sub-domain separately
             X_plot = []
             for i in range(n_dimensions):
@@ -209,30 +493,45 @@ class safe_BO():
         self.safety_threshold = safety_threshold
         self.tuple = tuple_ik
         self.lambda_bar = max(self.noise_std, 1)
+        self.adaptive_levels = adaptive_levels
+        self.compute_local_X_plot = compute_local_X_plot
+        self.delta_cube = delta_cube
+        points_per_axis = int(np.round(self.X_plot.shape[0]**(1/self.X_plot.shape[1])))
+        self.grid_origin = torch.zeros(self.n_dimensions)  # the coarse grid is grid_origin + integer multiples of grid_spacing
+        self.grid_spacing = torch.ones(self.n_dimensions)/(points_per_axis - 1)
         (i, k) = tuple_ik
         if (i, k) != (-1, -1):
+            self.center = X_sample[i].clone()
             self.lb = X_sample[i]-delta_cube*(k+1)
             self.ub = X_sample[i]+delta_cube*(k+1)
             self.lb[self.lb < 0] = 0
             self.ub[self.ub > 1] = 1  # clipping
             sample_indices = torch.all(torch.logical_and(X_sample >= self.lb, X_sample <= self.ub), axis=1)
+            self.sample_key = sample_bitmask(sample_indices)
             self.x_sample = X_sample[sample_indices].clone().detach()
             self.y_sample = Y_sample[sample_indices].clone().detach()
-            if not compute_local_X_plot:
+            if not compute_local_X_plot and isinstance(X_plot, lattice):  # index ranges of the box; cost scales with the cube, not with the domain
+                self.discr_domain = X_plot.box(self.lb, self.ub)
+            elif not compute_local_X_plot:
                 self.discr_domain = X_plot[torch.all(torch.logical_and(self.X_plot >= self.lb, self.X_plot <= self.ub), axis=1)]
             else:
-                self.discr_domain = compute_X_plot_locally(n_dimensions=self.X_plot.shape[1], points_per_axis=int(np.round(self.X_plot.shape[0]**(1/self.X_plot.shape[1]))),
+                self.discr_domain = compute_X_plot_locally(n_dimensions=self.X_plot.shape[1], points_per_axis=points_per_axis,
                                                            lb=self.lb, ub=self.ub)
+                self.grid_origin = self.lb.clone()
+                self.grid_spacing = (self.ub - self.lb)/(points_per_axis - 1)
         else:
             self.lb = torch.tensor([0]*X_plot.shape[1])
             self.ub = torch.tensor([1]*X_plot.shape[1])
             self.x_sample = X_sample
             self.y_sample = Y_sample
-            self.discr_domain = X_plot
-
-    def compute_model(self, dict_reuse_GPs, gpr):
-        if convert_to_hashable(self.x_sample) in dict_reuse_GPs.keys():
-            self.model, self.K = dict_reuse_GPs[convert_to_hashable(self.x_sample)]
+            self.sample_key = sample_bitmask(torch.ones(X_sample.shape[0], dtype=torch.bool))
+            self.discr_domain = X_plot.points() if isinstance(X_plot, lattice) else X_plot
+
+    @profiling.profiled('compute_model')
+    def compute_model(self, GP_models, gpr):
+        cached_model = GP_models.get(self.sample_key)  # same samples as a cube of this or an earlier iteration
+        if cached_model is not None:
+            self.model, self.K = cached_model
         else:
             if Furuta:
                 self.model = gpr(train_x=self.x_sample, train_y=self.y_sample, noise_std=self.noise_std, lengthscale=0.2)  # only change of the lengthscale
@@ -240,15 +539,39 @@ class safe_BO():
                 self.model = gpr(train_x=self.x_sample, train_y=self.y_sample, noise_std=self.noise_std, lengthscale=0.1)
             self.K = self.model(self.x_sample).covariance_matrix
             # model.train()
-            dict_reuse_GPs[convert_to_hashable(self.x_sample)] = [self.model, self.K]
+            GP_models.put(self.sample_key, [self.model, self.K])
         # return model
 
-    def compute_mean_var(self):  # GP model predictions
-        self.model.eval()
-        self.f_preds = self.model(self.discr_domain)
-        self.mean = self.f_preds.mean
-        self.var = self.f_preds.variance
+    @profiling.profiled('refresh_factors')
+    def refresh_factors(self):  # cube is reused in this iteration; keep its Gram factors for the next rank-one update
+        gram_factors.cholesky(self.model.kernel, self.x_sample, self.noise_std**2)
+        gram_factors.cholesky(self.model.kernel, self.x_sample, self.noise_std)
 
+    @profiling.profiled('compute_mean_var')
+    def compute_mean_var(self):  # GP model predictions from the (incrementally updated) Cholesky factor of K + noise_std^2*I
+        # only the marginals are needed; the grid is processed in chunks, so memory is O(chunk x n) and the N x N covariance is never formed
+        self.model.eval()
+        self.mean, self.var = self.posterior_marginals(self.discr_domain)
+
+    def posterior_marginals(self, X):  # posterior mean and marginal variance at the points X
+        L = gram_factors.cholesky(self.model.kernel, self.x_sample, self.noise_std**2)
+        constant_mean = self.model.mean_module.constant.detach()
+        alpha = torch.cholesky_solve((self.y_sample - constant_mean).reshape(-1, 1), L)
+        num_points = X.shape[0]
+        bytes_per_point = 3*X.element_size()*(self.x_sample.shape[0] + self.n_dimensions)  # cross-covariance, triangular solve, squares
+        chunk_size = int(max(1, min(num_points, posterior_memory_budget // bytes_per_point)))
+        mean = torch.empty(num_points, dtype=X.dtype)
+        var = torch.empty(num_points, dtype=X.dtype)
+        for start in range(0, num_points, chunk_size):
+            X_chunk = X[start:start+chunk_size]
+            K_cross = self.model.kernel(self.x_sample, X_chunk).evaluate()
+            mean[start:start+chunk_size] = constant_mean + (K_cross.T @ alpha).flatten()
+            V = torch.linalg.solve_triangular(L, K_cross, upper=False)
+            prior_var = self.model.kernel(X_chunk, X_chunk, diag=True)
+            var[start:start+chunk_size] = prior_var - torch.sum(V**2, dim=0)
+        return mean, var.clamp_min(gpytorch.settings.min_variance.value(mean.dtype))
+
+    @profiling.profiled('compute_confidence_intervals_training')
     def compute_confidence_intervals_training(self, dict_local_RKHS_norms={}):
         if self.tuple in dict_local_RKHS_norms:
             self.B = dict_local_RKHS_norms[self.tuple]
@@ -260,46 +583,33 @@ class safe_BO():
         self.ucb = self.mean + self.beta*torch.sqrt(self.var)
         return dict_local_RKHS_norms
 
-    def compute_confidence_intervals_evaluation(self, RNN_model=None, m_PAC=None, alpha_bar=None, PAC=False, RKHS_norm_guessed=None):  # PAC is a boolean that decides whether we are in the outer loop or inner loop
+    @profiling.profiled('compute_confidence_intervals_evaluation')
+    def compute_confidence_intervals_evaluation(self, RNN_model=None, m_PAC=None, alpha_bar=None, PAC=False, RKHS_norm_guessed=None, PAC_memory_budget=PAC_memory_budget, RKHS_norm_predicted=None):  # PAC is a boolean that decides whether we are in the outer loop or inner loop
         if RKHS_norm_guessed is None:
-            self.B = predict(RNN_model, self.RKHS_norm_mean_function_list, self.vi_frac_list)
+            if RKHS_norm_predicted is None:
+                self.B = RNN_states.predict_batch(RNN_model, [self.tuple], [self.RKHS_norm_mean_function_list], [self.vi_frac_list])[0]
+            else:  # already predicted together with the other cubes of this iteration
+                self.B = RKHS_norm_predicted
+            self.RKHS_norm_RNN = self.B
             if PAC:
-                list_random_RKHS_norms = []
                 N_hat = int(max(torch.round((torch.max(self.ub-self.lb))*500), len(self.y_sample) + 10))
                 print(f'Getting PAC bounds now for cube {self.tuple}.')
                 x_interpol = self.x_sample
                 y_interpol = self.y_sample
-                for _ in range(m_PAC):
-                    X_c = (torch.min(self.discr_domain) - torch.max(self.discr_domain))*torch.rand(N_hat, self.x_sample.shape[1]) + torch.max((self.discr_domain))
-                    X_c_tail = X_c[x_interpol.shape[0]:]
-                    X_c[:self.x_sample.shape[0]] = x_interpol
-                    alpha_tail = -2*alpha_bar*torch.rand(N_hat-len(y_interpol), 1) + alpha_bar
-                    y_tail = self.model.kernel(x_interpol, X_c_tail).evaluate() @ alpha_tail
-                    y_head = (y_interpol - torch.squeeze(y_tail)).reshape(-1, 1)
-                    # matrix inversion with nugget factor for regularization
-                    # Following line satisfies interpolation propoert
-                    alpha_head = torch.inverse(self.model.kernel(x_interpol, x_interpol).evaluate()+torch.eye(len(y_interpol))*1e-3) @ y_head
-                    alpha = torch.cat((alpha_head, alpha_tail))
-                    random_RKHS_norm = torch.sqrt(alpha.T @ self.model.kernel(X_c, X_c).evaluate() @ alpha)
-                    list_random_RKHS_norms.append(random_RKHS_norm)
-                numpy_list = [tensor.item() for tensor in list_random_RKHS_norms]
-                numpy_list.sort()
-                r_final = 0
-                for r in range(m_PAC):
-                    summ = 0
-                    for i in range(r):
-                        summ += comb(m_PAC, i)*gamma_PAC**(i)*(1-gamma_PAC)**(m_PAC-i)
-                    if summ > kappa_PAC or self.B > numpy_list[-1-r]:
-                        break
-                    else:
-                        r_final = r
-                self.B = max(self.B, numpy_list[-1-r_final])  # Algorithm 3; scenario approach with PAC bounds
+                r_max = scenario_approach_index(m_PAC, gamma_PAC, kappa_PAC)  # computed once per process
+                L_interpol = gram_factors.cholesky(self.model.kernel, x_interpol, 1e-3)  # nugget factor for regularization
+                with profiling.stage('PAC sampling', cube=self.tuple, N_hat=N_hat, m_PAC=m_PAC):
+                    # all m_PAC scenarios at once, chunked to the memory budget; same sorted norms as the former per-scenario loop
+                    numpy_list = scenario_RKHS_norms(self.model.kernel, x_interpol, y_interpol, lower=torch.min(self.discr_domain), upper=torch.max(self.discr_domain),
+                                                     N_hat=N_hat, m_PAC=m_PAC, alpha_bar=alpha_bar, memory_budget=PAC_memory_budget, L_interpol=L_interpol)
+                    self.B = scenario_approach_bound(self.B, numpy_list, r_max)  # Algorithm 3; scenario approach with PAC bounds
         elif RKHS_norm_guessed is not None:
             self.B = RKHS_norm_guessed
         self.compute_beta()
         self.lcb = self.mean - self.beta*torch.sqrt(self.var)  # we have to use standard deviation instead of variance
         self.ucb = self.mean + self.beta*torch.sqrt(self.var)
 
+    @profiling.profiled('compute_safe_set')
     def compute_safe_set(self):
         self.S = self.lcb > self.safety_threshold
 
@@ -307,6 +617,45 @@ class safe_BO():
         self.G = self.S.clone()
         self.M = self.S.clone()
 
+    @profiling.profiled('refine_discretization')
+    def refine_discretization(self):
+        '''
+        Adaptive discretization. Starting from the coarse grid, every level halves the spacing around points whose cell
+        contains the boundary lcb = safety_threshold (a point of the other kind within one cell diagonal) and around potential maximizers.
+        Only mean, variance and bounds of the new points are computed; the RNN features were computed on the coarse grid before.
+        '''
+        spacing = self.grid_spacing.clone()
+        new = torch.ones(self.discr_domain.shape[0], dtype=torch.bool)  # only points of the last level are refined further
+        for _ in range(self.adaptive_levels):
+            S = self.lcb > self.safety_threshold
+            refine = torch.zeros_like(new)
+            if torch.any(S) and not torch.all(S):  # boundary cells, on both sides
+                for side in [S, ~S]:
+                    tree = cKDTree(self.discr_domain[~side].numpy())
+                    distance, _ = tree.query(self.discr_domain[new & side].numpy(), distance_upper_bound=float(torch.linalg.vector_norm(spacing))*(1 + 1e-6))
+                    refine[torch.nonzero(new & side).flatten()[torch.from_numpy(np.isfinite(distance))]] = True
+            if torch.any(S):  # potential maximizers; the best lower bound of the other cubes is not known yet
+                refine[new & S & (self.ucb >= torch.max(self.lcb[S]))] = True
+            if not torch.any(refine):
+                break
+            spacing = spacing/2
+            offsets = torch.cat((torch.diag(spacing), -torch.diag(spacing)))  # neighbours along each axis at the new spacing
+            children = (self.discr_domain[refine].unsqueeze(1) + offsets.unsqueeze(0)).reshape(-1, self.n_dimensions)
+            keys = torch.unique(torch.round((children - self.grid_origin)/spacing).long(), dim=0)  # children of neighbouring cells coincide
+            children = self.grid_origin + keys*spacing
+            children = children[torch.all(torch.logical_and(children >= self.lb, children <= self.ub), axis=1)]
+            if children.shape[0] == 0:
+                break
+            mean, var = self.posterior_marginals(children)
+            self.discr_domain = torch.cat((self.discr_domain, children))
+            self.mean = torch.cat((self.mean, mean))
+            self.var = torch.cat((self.var, var))
+            self.lcb = torch.cat((self.lcb, mean - self.beta*torch.sqrt(var)))
+            self.ucb = torch.cat((self.ucb, mean + self.beta*torch.sqrt(var)))
+            new = torch.cat((torch.zeros_like(new), torch.ones(children.shape[0], dtype=torch.bool)))
+        self.compute_safe_set()
+
+    @profiling.profiled('maximizer_routine')
     def maximizer_routine(self, best_lower_bound_others):
         self.M[:] = False  # initialize
         self.max_M_var = 0  # initialize
@@ -320,6 +669,7 @@ class safe_BO():
         self.max_M_var = torch.max(self.ucb[self.M] - self.lcb[self.M])
         self.max_M_ucb = torch.max(self.ucb[self.M])
 
+    @profiling.profiled('expander_routine')
     def expander_routine(self):
         self.G[:] = False  # initialize
         if not torch.any(self.S) or torch.all(self.S):  # no safe points or all of them are safe points -> no possible expanders
@@ -336,29 +686,71 @@ class safe_BO():
             return
         potential_expanders = self.discr_domain[s]
         unsafe_points = self.discr_domain[~self.S]
-        kernel_distance = self.compute_kernel_distance(potential_expanders, unsafe_points)
-        ucb_expanded = self.ucb[s].unsqueeze(1).expand(-1, kernel_distance.size(1))
-        s[s.clone()] = torch.any(ucb_expanded - self.B*kernel_distance > self.safety_threshold, dim=1)
-        # or go with for loop; might be more scalable, but slower for smaller dimensions
-        # boolean_expander = ~s[s.clone()]  # assume that all are NOT expanders and go in the loop
-        # for i in range(len(potential_expanders)):
-        #     potential_expander = potential_expanders[i]
-        #     for unsafe_point in unsafe_points:
-        #         if self.ucb[s][i] - self.compute_kernel_distance(potential_expander, unsafe_point) > self.safety_threshold:
-        #             boolean_expander[i] = True
-        #             break  # we only need one!  
-        # s[s.clone()] = boolean_expander  # update the potential expanders on whether they can potentially expand to an unsafe point            
+        strategy = self.choose_expander_strategy(potential_expanders.shape[0], unsafe_points.shape[0])
+        if strategy == 'nearest':  # ucb - B*kernel distance is largest for the nearest unsafe point; O(|S| log N) instead of an |S| x N matrix
+            kernel_distance = self.compute_nearest_kernel_distance(potential_expanders, unsafe_points)
+            s[s.clone()] = self.ucb[s] - self.B*kernel_distance > self.safety_threshold
+        elif strategy == 'dense':
+            kernel_distance = self.compute_kernel_distance(potential_expanders, unsafe_points)
+            ucb_expanded = self.ucb[s].unsqueeze(1).expand(-1, kernel_distance.size(1))
+            s[s.clone()] = torch.any(ucb_expanded - self.B*kernel_distance > self.safety_threshold, dim=1)
+        else:  # blocks of the dense matrix; rows are dropped as soon as they found one unsafe point they can expand to
+            entries = max(1, expander_memory_budget // self.expander_bytes_per_entry())
+            if strategy == 'per_point':  # the former for loop over potential expanders, vectorized over the unsafe points
+                row_block = 1
+            else:
+                row_block = min(potential_expanders.shape[0], max(1, math.isqrt(entries)))
+            column_block = max(1, min(unsafe_points.shape[0], entries // row_block))
+            s[s.clone()] = self.expander_blocks(potential_expanders, unsafe_points, self.ucb[s], row_block, column_block)
         self.G = s
 
+    def expander_bytes_per_entry(self):  # kernel matrix, kernel distance and comparison per (expander, unsafe point) pair
+        return 3*self.discr_domain.element_size()
+
+    def choose_expander_strategy(self, num_expanders, num_unsafe):
+        '''
+        Cost model for the expander test. The nearest-unsafe-point query is exact for radial kernels and B >= 0 and needs O(N) memory.
+        Otherwise, the dense |S| x |~S| matrix is used if it fits into expander_memory_budget, the per-point loop
+        if there are only few potential expanders, and blocks of the matrix with early exit in all other cases.
+        '''
+        if expander_strategy != 'auto':
+            return expander_strategy
+        if self.model.kernel.__class__.__name__ in radial_kernels and self.B >= 0:
+            return 'nearest'
+        if num_expanders*num_unsafe*self.expander_bytes_per_entry() <= expander_memory_budget:
+            return 'dense'
+        if num_expanders <= expander_per_point_max:
+            return 'per_point'
+        return 'chunked'
+
+    def expander_blocks(self, potential_expanders, unsafe_points, ucb, row_block, column_block):
+        boolean_expander = torch.zeros(potential_expanders.shape[0], dtype=torch.bool)  # assume that all are NOT expanders
+        for row_start in range(0, potential_expanders.shape[0], row_block):
+            rows = torch.arange(row_start, min(row_start + row_block, potential_expanders.shape[0]))
+            for column_start in range(0, unsafe_points.shape[0], column_block):
+                kernel_distance = self.compute_kernel_distance(potential_expanders[rows], unsafe_points[column_start:column_start+column_block])
+                found = torch.any(ucb[rows].unsqueeze(1) - self.B*kernel_distance > self.safety_threshold, dim=1)
+                boolean_expander[rows[found]] = True
+                rows = rows[~found]  # we only need one!
+                if rows.numel() == 0:
+                    break
+        return boolean_expander
+
+    @profiling.profiled('compute_beta')
     def compute_beta(self):
         # Fiedler et al. 2024 Equation (7); based on Abbasi-Yadkori 2013
-        inside_log = torch.det(torch.eye(self.x_sample.shape[0]) + (1/self.noise_std*self.K))
-        inside_sqrt = self.noise_std*torch.log(inside_log) - (2*self.noise_std*torch.log(torch.tensor(self.delta_confidence)))
+        # log det(I + K/noise_std) = log det(K + noise_std*I) - n*log(noise_std); no overflow and shared by all cubes with the same x_sample
+        log_inside_log = gram_factors.logdet(self.model.kernel, self.x_sample, self.noise_std) - self.x_sample.shape[0]*math.log(self.noise_std)
+        inside_sqrt = self.noise_std*log_inside_log - (2*self.noise_std*torch.log(torch.tensor(self.delta_confidence)))
         self.beta = self.B + torch.sqrt(inside_sqrt)
 
 
     def compute_RKHS_norm_true(self):
-        return self.gt.local_RKHS_norm(lb=self.lb, ub=self.ub, X_plot_local=self.discr_domain) if self.tuple != (-1,-1) else self.gt.RKHS_norm
+        if self.tuple == (-1, -1):
+            return self.gt.RKHS_norm
+        if not self.compute_local_X_plot:  # same grid as the ground truth; the cubes (i, 0), ..., (i, k) share one factorization
+            return self.gt.local_RKHS_norm(lb=self.lb, ub=self.ub, center=self.center, radii=[self.delta_cube*(k+1) for k in range(self.tuple[1] + 1)])
+        return self.gt.local_RKHS_norm(lb=self.lb, ub=self.ub, X_plot_local=self.discr_domain)
 
     def compute_kernel_distance(self, x, x_prime):  # let us try whether it works without reshaped!
         '''
@@ -372,9 +764,24 @@ class safe_BO():
         matrix_containing_kernel_values = self.model.kernel(x, x_prime).evaluate()  # here we can have problems with the size of the matrix
         return torch.sqrt(2-2*matrix_containing_kernel_values)
 
+    def compute_nearest_kernel_distance(self, x, x_prime):
+        '''
+        Kernel distance of each point in x to its nearest point in x_prime.
+        Radial kernels only depend on the Euclidean distance after dividing by the lengthscale and sqrt(2-2k) increases with it,
+        so the nearest point w.r.t. the scaled coordinates also has the smallest kernel distance. Uses a KD-tree and never builds the full matrix.
+        '''
+        if self.model.kernel.__class__.__name__ not in radial_kernels:
+            raise Exception("Current implementation only works with radial kernels.")
+        lengthscale = self.model.kernel.lengthscale.detach().flatten().numpy()  # one entry, or one per dimension with ARD
+        tree = cKDTree(x_prime.numpy()/lengthscale)
+        _, nearest = tree.query(x.numpy()/lengthscale)
+        nearest = torch.from_numpy(nearest)
+        return torch.sqrt(2-2*self.model.kernel(x, x_prime[nearest], diag=True))
+
+    @profiling.profiled('save_data_for_RNN_training')
     def save_data_for_RNN_training(self, dict_mean_RKHS_norms, dict_recip_variances, x_last_iteration):
         if convert_to_hashable(self.tuple) not in dict_mean_RKHS_norms.keys():
-            alpha = torch.inverse(self.K+self.noise_std**2*torch.eye(self.K.shape[0])) @ self.y_sample
+            alpha = gram_factors.solve(self.model.kernel, self.x_sample, self.noise_std**2, self.y_sample.reshape(-1, 1))  # self.K = kernel(x_sample, x_sample)
             self.RKHS_norm_mean_function_list = [torch.sqrt(alpha.reshape(1, -1) @ self.K @ alpha.reshape(-1, 1)).flatten()]  # RKHS norm of the mean.
             dict_mean_RKHS_norms[self.tuple] = self.RKHS_norm_mean_function_list
 
@@ -383,8 +790,8 @@ class safe_BO():
             dict_recip_variances[self.tuple] = self.vi_frac_list
         elif x_last_iteration is None:
             pass
-        elif torch.all(torch.logical_and(x_last_iteration >= self.lb, x_last_iteration <= self.ub)):
-            alpha = torch.inverse(self.K+self.noise_std**2*torch.eye(self.K.shape[0])) @ self.y_sample
+        elif torch.any(torch.all(torch.logical_and(x_last_iteration >= self.lb, x_last_iteration <= self.ub), dim=-1)):  # one or several new samples in this cube
+            alpha = gram_factors.solve(self.model.kernel, self.x_sample, self.noise_std**2, self.y_sample.reshape(-1, 1))
             RKHS_norm_mean_function = torch.sqrt(alpha.reshape(1, -1) @ self.K @ alpha.reshape(-1, 1)).flatten()
             dict_mean_RKHS_norms[self.tuple].append(RKHS_norm_mean_function)
             self.RKHS_norm_mean_function_list = dict_mean_RKHS_norms[self.tuple]
@@ -398,12 +805,81 @@ class safe_BO():
         return dict_mean_RKHS_norms, dict_recip_variances
 
 
-def run(args):
+def separated_candidates(points, scores, X_taken, num_candidates, separation):
+    # up to num_candidates points in the order of decreasing scores that keep the separation to X_taken and to each other
+    candidates = []
+    for index in torch.argsort(scores, descending=True).tolist():
+        if len(candidates) >= num_candidates:
+            break
+        if torch.all(torch.max(torch.abs(X_taken - points[index]), dim=1).values >= separation):
+            candidates.append(points[index])
+            X_taken = torch.cat((X_taken, points[index].unsqueeze(0)), dim=0)
+    return candidates
+
+
+def conduct_experiment_task(task):  # one experiment of a batch; executed in the worker processes
+    x, seed = task
+    np.random.seed(seed)  # noise of each candidate is reproducible and independent of the worker
+    torch.manual_seed(seed)
+    return batch_context['gt'].conduct_experiment(x=x, noise_std=batch_context['noise_std'])
+
+
+def random_states():
+    return {'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+
+
+def set_random_states(states):
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+
+
+def dump_atomic(path, content):
+    # written to a temporary file and renamed, so that a crash while saving leaves the previous file intact
+    with open(path + '.tmp', 'wb') as handle:
+        dill.dump(content, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def checkpoint_cube_path(path, index):  # cubes of global_cube_list are written once each, next to the checkpoint
+    return f'{path}.cube_{index:05d}'
+
+
+def save_checkpoint(path, state, global_cube_list=(), num_saved_cubes=0):  # returns the number of cubes that are saved under path
+    for index in range(num_saved_cubes, len(global_cube_list)):
+        cube = copy.copy(global_cube_list[index])
+        cube.gt = None  # the ground truth is not part of the checkpoint of an evaluation run (hardware, process pools)
+        dump_atomic(checkpoint_cube_path(path, index), cube)
+    dump_atomic(path, dict(state, version=checkpoint_version, random_states=random_states(), num_global_cubes=len(global_cube_list)))
+    return len(global_cube_list)
+
+
+def load_checkpoint(path):
+    with open(path, 'rb') as handle:
+        state = dill.load(handle)
+    if state.get('version') != checkpoint_version:
+        raise Exception(f"Checkpoint {path} has version {state.get('version')}, but this code reads version {checkpoint_version}.")
+    state['global_cube_list'] = []
+    for index in range(state['num_global_cubes']):
+        with open(checkpoint_cube_path(path, index), 'rb') as handle:
+            state['global_cube_list'].append(dill.load(handle))
+    state['path'] = path
+    return state
+
+
+def resume(args, path):  # continue run(args) after the last experiment that was saved to path
+    return run(args, checkpoint=load_checkpoint(path))
+
+
+@profiling.profiled('run')
+def run(args, checkpoint=None, checkpoint_file=None):  # checkpoint_file overrides checkpoint_path
     training = args[-1]
     if training:  # boolean whether we are training or not
         hyperparameters, num_iterations, X_plot, RKHS_norm = args[:-1]
         global_approach = False
         noise_std, delta_confidence, exploration_threshold, delta_cube, num_local_cubes, compute_local_X_plot = hyperparameters
+        compute_all_sets = False
     if not training:
         hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, RNN_model, compute_local_X_plot = args[:-1]
         run_type = hyperparameters[-1]
@@ -421,10 +897,15 @@ def run(args):
         run_type = 'ours'
         dict_local_RKHS_norms = {}
         list_training = []  # we can do that a posteriori
-        gt = ground_truth(num_center_points=np.random.choice(range(600, 1000)), X_plot=X_plot, RKHS_norm=RKHS_norm)
-        X_sample_init, Y_sample_init = initial_safe_samples(gt=gt, num_safe_points=num_safe_points)
-        X_sample = X_sample_init.clone()
-        Y_sample = Y_sample_init.clone()
+        gt_random_states = random_states() if checkpoint is None else checkpoint['gt_random_states']
+        if checkpoint is None or checkpoint['gt'] is None:  # after a resume, the same random states give the same ground truth
+            set_random_states(gt_random_states)
+            gt = ground_truth(num_center_points=np.random.choice(range(600, 1000)), X_plot=X_plot, RKHS_norm=RKHS_norm)
+        gt.num_nested_boxes = num_local_cubes
+        if checkpoint is None:
+            X_sample_init, Y_sample_init = initial_safe_samples(gt=gt, num_safe_points=num_safe_points)
+            X_sample = X_sample_init.clone()
+            Y_sample = Y_sample_init.clone()
     if not global_approach:
         interesting_domains = set((i, k) for i in range(num_safe_points) for k in range(num_local_cubes))
         interesting_domains.add(tuple([-1, -1]))
@@ -432,8 +913,35 @@ def run(args):
         interesting_domains={tuple([-1, -1])}
 
     x_new_last_iteration = torch.tensor([-torch.inf for _ in range(n_dimensions)])  # init
+    profiling.count('grid', num_points=X_plot.shape[0], n_dimensions=X_plot.shape[1], compute_local_X_plot=compute_local_X_plot)
+    gram_factors.clear()  # factors only grow within one run
+    GP_models.clear()  # keys are rows of this run's X_sample
+    RNN_states.clear()  # keys are cube tuples of this run
     best_lower_bound_others = -np.infty  # init
     skip_global_domain = False  # init
+    dict_cubes = {}  # cubes that were not affected by any new sample since they were computed
+    num_saved_cubes = 0  # cubes of global_cube_list that are already saved next to the checkpoint
+    if checkpoint is not None:  # continue after the last experiment of an earlier session; the caches are rebuilt in the first iteration
+        if checkpoint['run_type'] != run_type or checkpoint['training'] != training:
+            raise Exception(f"Checkpoint belongs to a {checkpoint['run_type']} run (training: {checkpoint['training']}).")
+        X_sample, Y_sample = checkpoint['X_sample'], checkpoint['Y_sample']
+        interesting_domains = checkpoint['interesting_domains']
+        dict_mean_RKHS_norms, dict_recip_variances = checkpoint['dict_mean_RKHS_norms'], checkpoint['dict_recip_variances']
+        skip_global_domain = checkpoint['skip_global_domain']
+        x_new_last_iteration = checkpoint['x_new_last_iteration']
+        if training:
+            if checkpoint['gt'] is not None:
+                gt = checkpoint['gt']
+            dict_local_RKHS_norms = checkpoint['dict_local_RKHS_norms']
+        if checkpoint['gram_factors'] is not None:  # factors extended row by row differ in rounding from new ones
+            gram_factors.factors, gram_factors.used = checkpoint['gram_factors']
+        global_cube_list = checkpoint['global_cube_list']
+        for cube in global_cube_list:
+            cube.gt = gt
+        if checkpoint['path'] == (checkpoint_file or checkpoint_path):
+            num_saved_cubes = len(global_cube_list)
+        set_random_states(checkpoint['random_states'])
+        print(f'Resuming with {X_sample.shape[0]} samples.')
     while X_sample.shape[0] <= num_iterations:
         try:
             del chosen_cube  # just delete it completely
@@ -441,7 +949,8 @@ def run(args):
             pass
         best_lower_bound_others = -np.infty
         max_uncertainty_interesting = 0  # max uncertainty of interesting domain
-        dict_reuse_GPs = {}
+        gram_factors.new_iteration()
+        profiling.begin_iteration(num_samples=X_sample.shape[0])
         current_interesting_domains = interesting_domains.copy()
         if (-1, -1) in current_interesting_domains:  # we should iterate with the global domain
             current_interesting_domains.remove((-1, -1))
@@ -452,37 +961,59 @@ def run(args):
             domains_to_iterate_through.remove((-1, -1))
         if not training:
             print(f'We have {len(domains_to_iterate_through)} cubes to iterate through.')  # In SafeOpt, this is always 1
+        batch_cubes = []  # (uncertainty, cube) of all cubes with candidates; only needed for batch_size_q > 1
+        new_cubes = {}  # posterior and RNN inputs of all cubes that have to be (re)computed in this iteration
+        for (i, k) in domains_to_iterate_through:
+            if (i, k) not in dict_cubes:
+                cube = safe_BO(delta_confidence=delta_confidence, delta_cube=delta_cube, noise_std=noise_std, tuple_ik=(i, k), X_plot=X_plot, X_sample=X_sample,
+                                Y_sample=Y_sample, safety_threshold=gt.safety_threshold, exploration_threshold=exploration_threshold, gt=gt,
+                                compute_local_X_plot=compute_local_X_plot, compute_all_sets=compute_all_sets, adaptive_levels=adaptive_levels)  # all samples that we currently have
+                cube.compute_model(GP_models, gpr=GPRegressionModel)
+                cube.compute_mean_var()
+                if run_type == 'ours':
+                    dict_mean_RKHS_norms, dict_recip_variances = cube.save_data_for_RNN_training(dict_mean_RKHS_norms, dict_recip_variances, x_new_last_iteration)  # RKHS norm and reciprocal covariance integral
+                new_cubes[(i, k)] = cube
+        RKHS_norms_predicted = {}
+        if not training and run_type == 'ours' and len(new_cubes) > 0:  # one forward pass of the RNN for all of them
+            RKHS_norms_predicted = dict(zip(new_cubes.keys(), RNN_states.predict_batch(RNN_model, list(new_cubes.keys()), [cube.RKHS_norm_mean_function_list for cube in new_cubes.values()],
+                                                                                       [cube.vi_frac_list for cube in new_cubes.values()])))
         for (i, k) in domains_to_iterate_through:  # start off with global domain; sensible heuristic
             skip_global_domain = False  # only valid when starting the while loop and we want to skip the global domain for next round.
             try:
                 del cube  # reset
             except NameError:
                 pass
-            cube = safe_BO(delta_confidence=delta_confidence, delta_cube=delta_cube, noise_std=noise_std, tuple_ik=(i, k), X_plot=X_plot, X_sample=X_sample,
-                            Y_sample=Y_sample, safety_threshold=gt.safety_threshold, exploration_threshold=exploration_threshold, gt=gt,
-                            compute_local_X_plot=compute_local_X_plot, compute_all_sets=compute_all_sets)  # all samples that we currently have
-            cube.compute_model(dict_reuse_GPs, gpr=GPRegressionModel)
-            cube.compute_mean_var()
-            if run_type == 'ours':
-                dict_mean_RKHS_norms, dict_recip_variances = cube.save_data_for_RNN_training(dict_mean_RKHS_norms, dict_recip_variances, x_new_last_iteration)  # RKHS norm and reciprocal covariance integral
-            if training:
-                dict_local_RKHS_norms = cube.compute_confidence_intervals_training(dict_local_RKHS_norms=dict_local_RKHS_norms)
+            if (i, k) in dict_cubes:  # no new sample in this cube since it was computed; posterior, bounds and safe set are unchanged
+                cube = dict_cubes[(i, k)]
+                cube.refresh_factors()
             else:
-                if run_type == 'ours':
-                    cube.compute_confidence_intervals_evaluation(RNN_model=RNN_model, m_PAC=m_PAC, alpha_bar=alpha_bar, PAC=False)  # We do not need PAC bounds yet; improves speed. PAC bounds essential for sampling
-                elif run_type == 'SafeOpt':
-                    cube.compute_confidence_intervals_evaluation(RKHS_norm_guessed=B)
-            cube.compute_safe_set()
+                cube = new_cubes[(i, k)]
+                if training:
+                    dict_local_RKHS_norms = cube.compute_confidence_intervals_training(dict_local_RKHS_norms=dict_local_RKHS_norms)
+                else:
+                    if run_type == 'ours':
+                        cube.compute_confidence_intervals_evaluation(RNN_model=RNN_model, m_PAC=m_PAC, alpha_bar=alpha_bar, PAC=False, RKHS_norm_predicted=RKHS_norms_predicted[(i, k)])  # We do not need PAC bounds yet; improves speed. PAC bounds essential for sampling
+                    elif run_type == 'SafeOpt':
+                        cube.compute_confidence_intervals_evaluation(RKHS_norm_guessed=B)
+                cube.compute_safe_set()
+                if cube.adaptive_levels > 0:
+                    cube.refine_discretization()
+                dict_cubes[(i, k)] = cube
             cube.maximizer_routine(best_lower_bound_others=best_lower_bound_others)
             cube.expander_routine()
+            if profiling.enabled:
+                profiling.count('cube', cube=cube.tuple, discr_domain=cube.discr_domain.shape[0], S=int(torch.sum(cube.S)), M=int(torch.sum(cube.M)),
+                                G=int(torch.sum(cube.G)), num_samples=cube.x_sample.shape[0], reused=(i, k) not in new_cubes)
             if cube.best_lower_bound_local > best_lower_bound_others:
                 best_lower_bound_others = cube.best_lower_bound_local
             if not torch.any(torch.logical_or(cube.M, cube.G)):
                 if cube.tuple in interesting_domains:
                     interesting_domains.remove(cube.tuple)
+                    dict_cubes.pop(cube.tuple, None)  # only comes back once a new sample lands in it
             else:
                 max_uncertainty_interesting_local = max((cube.ucb - cube.lcb)[torch.logical_or(cube.M, cube.G)])
                 x_new_current = cube.discr_domain[torch.logical_or(cube.M, cube.G)][torch.argmax(cube.var[torch.logical_or(cube.M, cube.G)])]
+                batch_cubes.append((max_uncertainty_interesting_local, cube))
                 if not torch.any(torch.all(X_sample == x_new_current, axis=1)) and max_uncertainty_interesting_local > max_uncertainty_interesting:
                     max_uncertainty_interesting = max_uncertainty_interesting_local
                     chosen_tuple = cube.tuple
@@ -490,6 +1021,7 @@ def run(args):
                     x_new = x_new_current
                 elif torch.any(torch.all(X_sample == x_new_current, axis=1)) and cube.tuple in interesting_domains:
                     interesting_domains.remove(cube.tuple)
+                    dict_cubes.pop(cube.tuple, None)
         if run_type == 'SafeOpt':
             global_cube_list.append(cube)
         if not training and run_type == 'ours':
@@ -501,7 +1033,8 @@ def run(args):
                     print('Our algorithm terminated! There is no input that we can/want to sample next.')
                 break
 
-            dict_local_RKHS_norms = chosen_cube.compute_confidence_intervals_evaluation(RNN_model, m_PAC, alpha_bar, PAC=True)
+            dict_local_RKHS_norms = chosen_cube.compute_confidence_intervals_evaluation(RNN_model, m_PAC, alpha_bar, PAC=True, RKHS_norm_predicted=chosen_cube.RKHS_norm_RNN)
+            dict_cubes.pop(chosen_cube.tuple, None)  # bounds now use the PAC RKHS norm instead of the RNN prediction
             chosen_cube.compute_safe_set()
             chosen_cube.maximizer_routine(best_lower_bound_others=best_lower_bound_others)
             chosen_cube.expander_routine()
@@ -521,6 +1054,10 @@ def run(args):
                     if chosen_cube.tuple == (-1, -1):
                         skip_global_domain = True
                     x_new_last_iteration = None if torch.any(x_new_last_iteration > np.infty) else x_new_last_iteration
+                    if run_type == 'ours' and x_new_last_iteration is not None:  # as when all cubes were rebuilt, the cubes with the last sample get its RNN features once more
+                        for cube_tuple in [cube_tuple for cube_tuple, cached_cube in dict_cubes.items()
+                                           if torch.any(torch.all(torch.logical_and(x_new_last_iteration >= cached_cube.lb, x_new_last_iteration <= cached_cube.ub), dim=-1))]:
+                            del dict_cubes[cube_tuple]
                     continue
         else:
             try:
@@ -529,16 +1066,41 @@ def run(args):
             except:
                 print(f'{run_type} terminated! There is no input that we can/want to sample next.')
                 break
-        if not training or training:
-            pass
-        y_new = gt.conduct_experiment(x=x_new, noise_std=noise_std)
-        if y_new < gt.safety_threshold:
-            if training or run_type == 'SafeOpt':
-                warnings.warn('Sampled unsafe point!')  # this can happen with under-estimates RKHS norms
-            else:  # we do not tolerate unsafe sampling
-                raise Exception('Sampled unsafe point!')
-        X_sample = torch.cat((X_sample, x_new.unsqueeze(0)), dim=0)
-        Y_sample = torch.cat((Y_sample, y_new), dim=0)
+        x_batch = [x_new]
+        if batch_size_q > 1:  # further candidates from the most uncertain cubes; never more samples than num_iterations + 1
+            num_candidates = min(batch_size_q, num_iterations + 1 - X_sample.shape[0])
+            for _, batch_cube in sorted(batch_cubes, key=lambda item: -item[0]):
+                if len(x_batch) >= num_candidates:
+                    break
+                if not training and run_type == 'ours' and batch_cube is not chosen_cube:  # every candidate is safe w.r.t. the PAC bound of its cube
+                    batch_cube.compute_confidence_intervals_evaluation(RNN_model, m_PAC, alpha_bar, PAC=True, RKHS_norm_predicted=batch_cube.RKHS_norm_RNN)
+                    dict_cubes.pop(batch_cube.tuple, None)
+                    batch_cube.compute_safe_set()
+                    batch_cube.maximizer_routine(best_lower_bound_others=best_lower_bound_others)
+                    batch_cube.expander_routine()
+                candidates = torch.logical_or(batch_cube.M, batch_cube.G)
+                x_batch += separated_candidates(batch_cube.discr_domain[candidates], batch_cube.var[candidates], torch.cat((X_sample, torch.stack(x_batch))),
+                                                num_candidates - len(x_batch), batch_separation)
+            if len(x_batch) > 1:
+                print(f'Conducting {len(x_batch)} experiments in this round.')
+        if isinstance(gt, experiment_pool):  # all experiments of the round are in flight at once; the pool averages the episodes of each
+            futures = [gt.submit(x, noise_std=noise_std) for x in x_batch]
+            y_batch = [future.result() for future in futures]
+        elif len(x_batch) == 1 or training or not batch_parallel:  # the worker processes of training data generation cannot have a pool
+            y_batch = [gt.conduct_experiment(x=x, noise_std=noise_std) for x in x_batch]
+        else:
+            batch_context.update(gt=gt, noise_std=noise_std)
+            seeds = np.random.randint(0, 2**31 - 1, size=len(x_batch)).tolist()
+            with multiprocessing.get_context('fork').Pool(processes=min(len(x_batch), os.cpu_count())) as pool:
+                y_batch = pool.map(conduct_experiment_task, list(zip(x_batch, seeds)))
+        for x_new, y_new in zip(x_batch, y_batch):
+            if y_new < gt.safety_threshold:
+                if training or run_type == 'SafeOpt':
+                    warnings.warn('Sampled unsafe point!')  # this can happen with under-estimates RKHS norms
+                else:  # we do not tolerate unsafe sampling
+                    raise Exception('Sampled unsafe point!')
+            X_sample = torch.cat((X_sample, x_new.unsqueeze(0)), dim=0)
+            Y_sample = torch.cat((Y_sample, y_new), dim=0)
         if Furuta:  # always save in hardware;
             with open('furuta_hardware_X_sample.pickle', 'wb') as handle:
                 pickle.dump(X_sample, handle, protocol=pickle.HIGHEST_PROTOCOL)
@@ -550,15 +1112,29 @@ def run(args):
 
 
         # Which sub-domain changed through this new sample?
-        if not global_approach:
-            X_distance = torch.max(torch.abs(X_sample - x_new), dim=1).values
-            effect_tensor = X_distance.unsqueeze(1) <= torch.arange(1, num_local_cubes + 1) * delta_cube
-            indices = torch.nonzero(effect_tensor, as_tuple=False)
-            indices_set = {(i.item(), k.item()) for i, k in indices}
-            interesting_domains |= indices_set  # set union
-            interesting_domains.add((-1, -1))
-        x_new_last_iteration = copy.deepcopy(x_new)
+        for x_new in x_batch:
+            for cube_tuple in [cube_tuple for cube_tuple, cached_cube in dict_cubes.items() if torch.all(torch.logical_and(x_new >= cached_cube.lb, x_new <= cached_cube.ub))]:
+                del dict_cubes[cube_tuple]  # same test as the sample selection in safe_BO.__init__
+            if not global_approach:
+                X_distance = torch.max(torch.abs(X_sample - x_new), dim=1).values
+                effect_tensor = X_distance.unsqueeze(1) <= torch.arange(1, num_local_cubes + 1) * delta_cube
+                indices = torch.nonzero(effect_tensor, as_tuple=False)
+                indices_set = {(i.item(), k.item()) for i, k in indices}
+                interesting_domains |= indices_set  # set union
+                interesting_domains.add((-1, -1))
+        x_new_last_iteration = copy.deepcopy(x_new) if len(x_batch) == 1 else torch.stack(x_batch)  # the RNN features of a cube get one entry per round
         del x_new  # There is no x_new for the next iteration
+        if (checkpoint_file or checkpoint_path) is not None:  # what the next iteration cannot rebuild; cubes, models, factors and labels are recomputed after a resume
+            num_saved_cubes = save_checkpoint(checkpoint_file or checkpoint_path, {'run_type': run_type, 'training': training, 'X_sample': X_sample, 'Y_sample': Y_sample,
+                                                                                   'interesting_domains': interesting_domains, 'dict_mean_RKHS_norms': dict_mean_RKHS_norms,
+                                                                                   'dict_recip_variances': dict_recip_variances, 'skip_global_domain': skip_global_domain,
+                                                                                   'x_new_last_iteration': x_new_last_iteration,
+                                                                                   'dict_local_RKHS_norms': dict_local_RKHS_norms if training else None,
+                                                                                   'gt_random_states': gt_random_states if training else None,
+                                                                                   'gt': gt if training and checkpoint_bit_identical else None,
+                                                                                   'gram_factors': (gram_factors.factors, gram_factors.used) if checkpoint_bit_identical else None},
+                                              global_cube_list=global_cube_list, num_saved_cubes=num_saved_cubes)
+    profiling.end_iteration()
     if training:
         list_training = []
         for key in dict_mean_RKHS_norms.keys():
@@ -568,6 +1144,61 @@ def run(args):
         return X_sample, Y_sample, global_cube_list, gt.safety_threshold
 
 
+def training_shard_path(shard_dir, task_index):
+    return os.path.join(shard_dir, f'training_data_{task_index:05d}.pickle')
+
+
+def run_training_task(task):  # one random RKHS function; also executed in the worker processes
+    task_index, seed, num_threads, shard_dir, args = task
+    torch.manual_seed(seed)  # deterministic per task, independent of the worker that picks it up
+    np.random.seed(seed)
+    torch.set_num_threads(num_threads)
+    task_checkpoint_path = None if checkpoint_path is None else f'{checkpoint_path}.task_{task_index:05d}'  # tasks run in parallel; one checkpoint each
+    checkpoint = load_checkpoint(task_checkpoint_path) if task_checkpoint_path is not None and os.path.exists(task_checkpoint_path) else None
+    with torch.no_grad(), gpytorch.settings.fast_pred_var():
+        list_training = run(args, checkpoint=checkpoint, checkpoint_file=task_checkpoint_path)
+    shard_path = training_shard_path(shard_dir, task_index)
+    with open(shard_path + '.tmp', 'wb') as handle:
+        pickle.dump(list_training, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(shard_path + '.tmp', shard_path)  # atomic; a crash never leaves a half-written shard behind
+    if task_checkpoint_path is not None and os.path.exists(task_checkpoint_path):  # the shard supersedes it
+        os.remove(task_checkpoint_path)
+    return task_index
+
+
+def generate_training_data(task_input, shard_dir, store_path, parallel=True, num_workers=None, seed=0):
+    # Every random RKHS function is written to its own shard; tasks whose shard already exists are skipped (resume).
+    # Finished functions are appended to the sequence store at store_path, tagged with their task index.
+    os.makedirs(shard_dir, exist_ok=True)
+    store = sequence_store(store_path, mode='a')
+    stored_tasks = store.groups()
+
+    def append_to_store(task_index):
+        if task_index in stored_tasks:
+            return
+        with open(training_shard_path(shard_dir, task_index), 'rb') as handle:
+            store.append(pickle.load(handle), group=task_index)
+        stored_tasks.add(task_index)
+
+    num_workers = num_workers or os.cpu_count()
+    num_threads = max(1, torch.get_num_threads() // num_workers) if parallel else torch.get_num_threads()
+    tasks = []
+    for task_index, args in enumerate(task_input):
+        if os.path.exists(training_shard_path(shard_dir, task_index)):
+            append_to_store(task_index)
+        else:
+            tasks.append((task_index, seed + task_index, num_threads, shard_dir, args))
+    print(f'{len(task_input) - len(tasks)} out of {len(task_input)} random RKHS functions are already done.')
+    if parallel:
+        with mp.Pool(processes=num_workers) as pool:
+            for task_index in tqdm(pool.imap_unordered(run_training_task, tasks), total=len(tasks)):
+                append_to_store(task_index)
+    else:
+        for task in tqdm(tasks):
+            append_to_store(run_training_task(task))
+    return store
+
+
 if __name__ == '__main__':
     script_dir = os.path.dirname(os.path.abspath(__file__))
     os.chdir(script_dir)
@@ -587,7 +1218,8 @@ if __name__ == '__main__':
     points_per_axis = 1000  # 30 for 4D, 1000 for 1D, 500 for 2D, 100 for 3D, 8 for 6D. Depends on computational resources, also a "hyperparameter"
 
     # Initialize our algorithm
-    X_plot = compute_X_plot(n_dimensions, points_per_axis)
+    X_lattice = lattice(n_dimensions, points_per_axis)  # passed to run(); cubes only take index ranges of it
+    X_plot = X_lattice.points()  # the full grid for the ground truth and the plots; the same tensor as the global cube of run()
     delta_cube = 0.1  # hyperparameter
     num_local_cubes = 5
 
@@ -604,21 +1236,13 @@ if __name__ == '__main__':
     if training:
         compute_local_X_plot = False
         hyperparameters = [noise_std, delta_confidence, exploration_threshold, delta_cube, num_local_cubes, compute_local_X_plot]
-        with torch.no_grad(), gpytorch.settings.fast_pred_var():
-            parallel = False 
-            number_of_random_RKHS_function = 1000
-            task_input = [(hyperparameters, num_iterations, X_plot, np.random.uniform(0.5, 30), training) for _ in range(number_of_random_RKHS_function)]
-            if parallel:
-                with mp.Pool() as pool:
-                    collected_training = pool.map(run, task_input)
-            else:
-                collected_list_training = []
-                for task in tqdm(task_input):
-                    list_training = run(task)
-                    collected_list_training.append(list_training)
-        with open('1D_training_data.pickle', 'wb') as handle:
-            pickle.dump(collected_list_training, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        print('Training finished!')
+        parallel = True
+        number_of_random_RKHS_function = 1000
+        seed = 0  # the task list must be reproducible to resume from the shards
+        RKHS_norms = np.random.default_rng(seed).uniform(0.5, 30, size=number_of_random_RKHS_function)
+        task_input = [(hyperparameters, num_iterations, X_lattice, RKHS_norm, training) for RKHS_norm in RKHS_norms]
+        training_store = generate_training_data(task_input, shard_dir='training_shards', store_path='1D_training_data', parallel=parallel, seed=seed)
+        print(f'Training finished! {len(training_store)} sequences in {training_store.path}; read them with training_store.batches().')
     # For "evaluating"
     if not training and not Gym and not Furuta:
         kappa_PAC = 0.01  # confidence PAC bounds
@@ -669,17 +1293,17 @@ if __name__ == '__main__':
 
                 B = RKHS_norm/5
                 hyperparameters = [noise_std, delta_confidence, exploration_threshold, B, compute_all_sets, run_type]
-                X_sample_SO_under, Y_sample_SO_under, global_cube_list_under, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, None, compute_local_X_plot, training])
+                X_sample_SO_under, Y_sample_SO_under, global_cube_list_under, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, global_approach, None, compute_local_X_plot, training])
                 plot_1D_SafeOpt_with_sets(global_cube_list_under[0], gt, save=False, title='SafeOpt under first')
 
                 B = RKHS_norm
                 hyperparameters = [noise_std, delta_confidence, exploration_threshold, B, compute_all_sets, run_type]
-                X_sample_SO_true, Y_sample_SO_true, global_cube_list_true, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, None, compute_local_X_plot, training])
+                X_sample_SO_true, Y_sample_SO_true, global_cube_list_true, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, global_approach, None, compute_local_X_plot, training])
                 plot_1D_SafeOpt_with_sets(global_cube_list_true[-1], gt, save=False, title='SafeOpt true last')
 
                 B = RKHS_norm*5
                 hyperparameters = [noise_std, delta_confidence, exploration_threshold, B, compute_all_sets, run_type]
-                X_sample_SO_over, Y_sample_SO_over, global_cube_list_over, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, None, compute_local_X_plot, training])
+                X_sample_SO_over, Y_sample_SO_over, global_cube_list_over, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, global_approach, None, compute_local_X_plot, training])
                 plot_1D_SafeOpt_with_sets(global_cube_list_over[0], gt, save=False, title='SafeOpt over first')
 
         if not introductory_example:
@@ -691,7 +1315,7 @@ if __name__ == '__main__':
                 global_approach = True
                 B = RKHS_norm/5
                 hyperparameters = [noise_std, delta_confidence, exploration_threshold, B, compute_all_sets, run_type]
-                X_sample_SO_under, Y_sample_SO_under, global_cube_list_under, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, None, compute_local_X_plot, training])
+                X_sample_SO_under, Y_sample_SO_under, global_cube_list_under, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, global_approach, None, compute_local_X_plot, training])
                 if n_dimensions == 1:
                     plot_1D(X_sample_SO_under, Y_sample_SO_under, X_plot, gt.fX, title='SafeOpt under', safety_threshold=gt.safety_threshold, save=False)
                 elif n_dimensions == 2:
@@ -699,7 +1323,7 @@ if __name__ == '__main__':
 
                 B = RKHS_norm*5
                 hyperparameters = [noise_std, delta_confidence, exploration_threshold, B, compute_all_sets, run_type]
-                X_sample_SO_over, Y_sample_SO_over, global_cube_list_over, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, None, compute_local_X_plot, training])
+                X_sample_SO_over, Y_sample_SO_over, global_cube_list_over, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, global_approach, None, compute_local_X_plot, training])
                 if n_dimensions == 1:
                     plot_1D(X_sample_SO_over, Y_sample_SO_over, X_plot, gt.fX, title='SafeOpt over', safety_threshold=gt.safety_threshold, save=False)
                 elif n_dimensions == 2:
@@ -715,7 +1339,7 @@ if __name__ == '__main__':
                 num_classes = 1
                 RNN_model = load_model(model_path, hidden_size, num_layers, num_classes)
                 global_approach = False
-                X_sample_our, Y_sample_our, global_cube, safety_threshold = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, RNN_model, compute_local_X_plot, training])
+                X_sample_our, Y_sample_our, global_cube, safety_threshold = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_lattice, global_approach, RNN_model, compute_local_X_plot, training])
                 if n_dimensions == 1:
                     plot_1D(X_sample=X_sample_our, Y_sample=Y_sample_our, X_plot=X_plot, fX=gt.fX, title='ours', safety_threshold=safety_threshold, save=False)
                 elif n_dimensions == 2:
@@ -742,8 +1366,9 @@ if __name__ == '__main__':
         exploration_threshold = 0.1  # exploration threshold, see Sui et al. 2015
         n_dimensions = 2  # depends on experiment
         points_per_axis = 500  # 30 for 4D, 1000 for 1D, 400-500 for 2D, 100 for 3D, 15 for 5D
+        num_episodes = 4  # rollouts per experiment, run in parallel and averaged
         X_plot = compute_X_plot(n_dimensions, points_per_axis)
-        gte = ground_truth_experiment(environment=environment)
+        gte = experiment_pool(functools.partial(ground_truth_experiment, environment=environment), num_workers=num_episodes*batch_size_q, num_episodes=num_episodes)
         X_sample_init, Y_sample_init = gte.initial_safe_samples()
         X_sample = X_sample_init.clone().to(torch.float32)
         Y_sample = Y_sample_init.clone()
@@ -764,7 +1389,7 @@ if __name__ == '__main__':
             B = 0.2
             print(run_type, B)
             hyperparameters = [noise_std, delta_confidence, exploration_threshold, B, run_type]
-            X_sample_SO_under, Y_sample_SO_under, global_cube_list_under, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, None, compute_local_X_plot, training])
+            X_sample_SO_under, Y_sample_SO_under, global_cube_list_under, _ = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gte, X_plot, global_approach, None, compute_local_X_plot, training])
         with torch.no_grad(), gpytorch.settings.fast_pred_var():
             compute_local_X_plot = True
             run_type = 'ours'
@@ -778,7 +1403,8 @@ if __name__ == '__main__':
             num_classes = 1
             RNN_model = load_model(model_path, hidden_size, num_layers, num_classes)
             global_approach = False
-            X_sample_our, Y_sample_our, global_cube, safety_threshold = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gt, X_plot, global_approach, RNN_model, compute_local_X_plot, training])
+            X_sample_our, Y_sample_our, global_cube, safety_threshold = run(args=[hyperparameters, num_iterations, X_sample, Y_sample, gte, X_plot, global_approach, RNN_model, compute_local_X_plot, training])
+            gte.close()
             print("Finished; starting plots.")
             plot_gym(Y_sample=Y_sample_SO_over, safety_threshold=0, title='SafeOpt over', save=False)
             plot_gym(Y_sample=Y_sample_SO_under, safety_threshold=0, title='SafeOpt under', save=False)
@@ -796,6 +1422,14 @@ if __name__ == '__main__':
                 self.last_two_entries = np.array([-1.5040040945983464, 3.0344775662414483])  # these are kept constant
                 with QubeBalanceEnv(use_simulator=use_simulator, frequency=self.frequency) as env:
                     self.state_init = env.reset()
+                self.env = None  # simulator that is kept open between experiments
+
+            def environment(self):  # the hardware is opened for each experiment, as before
+                if not self.use_simulator:
+                    return QubeSwingupEnv(use_simulator=False, frequency=self.frequency)
+                if self.env is None:
+                    self.env = QubeSwingupEnv(use_simulator=True, frequency=self.frequency)
+                return nullcontext(self.env)
 
             def conduct_experiment(self, x, noise_std=None):
                 param = np.asarray(x, dtype=np.float64)
@@ -804,7 +1438,7 @@ if __name__ == '__main__':
                 reward = 0
                 if not self.use_simulator:
                     IPS()
-                with QubeSwingupEnv(use_simulator=self.use_simulator, frequency=self.frequency) as env:
+                with self.environment() as env:
                     env.reset()
                     swing_up_ctrl = QubeFlipUpControl(sample_freq=self.frequency, env=env)
                     upright = False
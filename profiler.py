@@ -0,0 +1,185 @@
+import functools
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager, nullcontext
+import torch
+try:  # tracking the largest tensor relies on the dispatch mode of recent torch versions
+    from torch.utils._python_dispatch import TorchDispatchMode
+    from torch.utils._pytree import tree_flatten
+except ImportError:
+    TorchDispatchMode = None
+
+
+def peak_rss():  # largest resident set of the process so far, in bytes
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*(1 if sys.platform == 'darwin' else 1024)
+
+
+def current_rss():  # in bytes; None where /proc is not available
+    try:
+        with open('/proc/self/statm') as handle:
+            return int(handle.read().split()[1])*os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def storage_pointer(tensor):
+    try:
+        return tensor.untyped_storage().data_ptr()
+    except (RuntimeError, NotImplementedError):  # e.g., sparse tensors have no storage
+        return None
+
+
+def storage_bytes(tensor):
+    try:
+        return tensor.untyped_storage().nbytes()
+    except (RuntimeError, NotImplementedError):
+        return 0
+
+
+if TorchDispatchMode is not None:
+    class largest_tensor_mode(TorchDispatchMode):
+        # size of the largest tensor produced by any torch operation, for all stages that are currently open
+        def __init__(self, frames):
+            super().__init__()
+            self.frames = frames
+
+        def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+            out = func(*args, **(kwargs or {}))
+            # bytes of new storage; views (e.g., expand) and in-place results share the storage of an input and allocate nothing
+            input_storages = {storage_pointer(t) for t in tree_flatten((args, kwargs))[0] if isinstance(t, torch.Tensor)}
+            num_bytes = max((storage_bytes(t) for t in tree_flatten(out)[0] if isinstance(t, torch.Tensor) and storage_pointer(t) not in input_storages), default=0)
+            for frame in self.frames:
+                if num_bytes > frame['largest_tensor_bytes']:
+                    frame['largest_tensor_bytes'] = num_bytes
+                    frame['largest_tensor_op'] = str(func)
+            return out
+
+
+class profiler():
+    '''
+    Opt-in timing of the stages of run(). Disabled, a stage costs one attribute check.
+    Enabled, every stage is recorded with its iteration and cube, and count events hold the sizes of the sets of each cube.
+    The events can be exported as Chrome trace (chrome://tracing, Perfetto) or as JSON lines.
+    In memory mode, every stage additionally records the largest tensor allocated inside it, the peak resident set of the process
+    at its end and by how much the stage raised it, e.g., to size points_per_axis to a machine. This slows the run down noticeably.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.memory_frames = []
+        self.dispatch_mode = None
+        self.events = []
+        self.iteration = None
+        self.iteration_start = None
+        self.iteration_args = {}
+        self.t0 = time.perf_counter()
+
+    def enable(self, memory=False):  # also discards the events of earlier runs
+        self.enabled = True
+        self.memory = memory
+        self.events = []
+        self.iteration = None
+        self.iteration_start = None
+        self.t0 = time.perf_counter()
+
+    def disable(self):
+        self.end_iteration()
+        self.enabled = False
+
+    def record(self, name, start, duration, cube=None, kind='span', **args):
+        self.events.append({'name': name, 'kind': kind, 'start': start - self.t0, 'duration': duration, 'iteration': self.iteration,
+                            'cube': list(cube) if cube is not None else None, 'args': args})
+
+    @contextmanager
+    def timed(self, name, cube=None, **args):
+        frame = self.begin_memory() if self.memory else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            if frame is not None:
+                args.update(self.end_memory(frame))
+            self.record(name, start, duration, cube=cube, **args)
+
+    def begin_memory(self):
+        frame = {'largest_tensor_bytes': 0, 'largest_tensor_op': None, 'peak_rss_start': peak_rss()}
+        self.memory_frames.append(frame)
+        if len(self.memory_frames) == 1 and TorchDispatchMode is not None:  # one dispatch mode serves all nested stages
+            self.dispatch_mode = largest_tensor_mode(self.memory_frames)
+            self.dispatch_mode.__enter__()
+        return frame
+
+    def end_memory(self, frame):
+        del self.memory_frames[next(i for i, open_frame in enumerate(self.memory_frames) if open_frame is frame)]  # by identity; frames may compare equal
+        if len(self.memory_frames) == 0 and self.dispatch_mode is not None:
+            self.dispatch_mode.__exit__(None, None, None)
+            self.dispatch_mode = None
+        peak_rss_end = peak_rss()
+        return {'largest_tensor_bytes': frame['largest_tensor_bytes'], 'largest_tensor_op': frame['largest_tensor_op'],
+                'peak_rss_bytes': peak_rss_end, 'peak_rss_increase_bytes': peak_rss_end - frame['peak_rss_start'], 'rss_bytes': current_rss()}
+
+    def stage(self, name, cube=None, **args):  # with profiling.stage('name', cube=...):
+        return self.timed(name, cube=cube, **args) if self.enabled else nullcontext()
+
+    def profiled(self, name):  # decorator; the cube is taken from the tuple of safe_BO objects
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.timed(name, cube=getattr(args[0], 'tuple', None) if args else None):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name, cube=None, **args):  # instant event, e.g., |discr_domain|, |S|, |M|, |G| of a cube
+        if self.enabled:
+            self.record(name, time.perf_counter(), 0, cube=cube, kind='count', **args)
+
+    def begin_iteration(self, **args):
+        if not self.enabled:
+            return
+        self.end_iteration()
+        self.iteration = 0 if self.iteration is None else self.iteration + 1
+        self.iteration_start = time.perf_counter()
+        self.iteration_args = args
+
+    def end_iteration(self):
+        if self.enabled and self.iteration_start is not None:
+            self.record('iteration', self.iteration_start, time.perf_counter() - self.iteration_start, **self.iteration_args)
+            self.iteration_start = None
+
+    def summary(self):  # per stage: number of calls, total time and, in memory mode, the largest tensor and the largest increase of the peak RSS
+        stages = {}
+        for event in self.events:
+            if event['kind'] != 'span':
+                continue
+            stage = stages.setdefault(event['name'], {'calls': 0, 'time': 0.0})
+            stage['calls'] += 1
+            stage['time'] += event['duration']
+            for key in ['largest_tensor_bytes', 'peak_rss_increase_bytes', 'peak_rss_bytes']:
+                if key in event['args']:
+                    stage[key] = max(stage.get(key, 0), event['args'][key])
+        return stages
+
+    def export_chrome_trace(self, path):
+        trace_events = []
+        for event in self.events:
+            trace_event = {'name': event['name'], 'ph': 'X' if event['kind'] == 'span' else 'i', 'ts': event['start']*1e6, 'pid': os.getpid(),
+                           'tid': 0 if event['cube'] is None else 1, 'args': dict(event['args'], iteration=event['iteration'], cube=event['cube'])}
+            if trace_event['ph'] == 'X':
+                trace_event['dur'] = event['duration']*1e6
+            else:
+                trace_event['s'] = 't'
+            trace_events.append(trace_event)
+        with open(path, 'w') as handle:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, handle)
+
+    def export_jsonl(self, path):
+        with open(path, 'w') as handle:
+            for event in self.events:
+                handle.write(json.dumps(event) + '\n')
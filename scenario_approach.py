@@ -0,0 +1,98 @@
+import bisect
+from functools import lru_cache
+import numpy as np
+import torch
+from scipy.special import gammaln
+
+
+PAC_memory_budget = 2**28  # bytes available for one chunk of scenarios (256 MB)
+
+
+def scenario_RKHS_norms(kernel, x_interpol, y_interpol, lower, upper, N_hat, m_PAC, alpha_bar, nugget=1e-3, memory_budget=PAC_memory_budget, L_interpol=None):
+    '''
+    Batched version of the scenario loop of Algorithm 3. Draws m_PAC random RKHS functions that interpolate (x_interpol, y_interpol)
+    and returns their sorted RKHS norms. The random numbers are drawn in the same order as in the sequential loop,
+    all kernel evaluations and matrix products are done for a whole chunk of scenarios at once.
+    '''
+    n, n_dimensions = x_interpol.shape
+    # K(X_c, X_c) dominates; the Matérn kernel keeps a few temporaries of the same size alive
+    bytes_per_scenario = 4*x_interpol.element_size()*N_hat*(N_hat + n + n_dimensions + 1)
+    chunk_size = int(max(1, min(m_PAC, memory_budget // bytes_per_scenario)))
+    if L_interpol is None:  # Cholesky factor of the regularized Gram matrix; does not change between scenarios
+        L_interpol = torch.linalg.cholesky(kernel(x_interpol, x_interpol).evaluate() + torch.eye(n)*nugget)  # nugget factor for regularization
+    list_random_RKHS_norms = []
+    for start in range(0, m_PAC, chunk_size):
+        batch_size = min(chunk_size, m_PAC - start)
+        X_c = torch.empty(batch_size, N_hat, n_dimensions, dtype=x_interpol.dtype)
+        alpha_tail = torch.empty(batch_size, N_hat - n, 1, dtype=x_interpol.dtype)
+        for j in range(batch_size):  # same random stream as the sequential loop
+            X_c[j] = (lower - upper)*torch.rand(N_hat, n_dimensions) + upper
+            alpha_tail[j] = -2*alpha_bar*torch.rand(N_hat - n, 1) + alpha_bar
+        X_c_tail = X_c[:, n:]
+        X_c[:, :n] = x_interpol
+        y_tail = kernel(x_interpol.expand(batch_size, n, n_dimensions), X_c_tail).evaluate() @ alpha_tail
+        y_head = y_interpol.reshape(1, -1, 1) - y_tail
+        # Following line satisfies interpolation property
+        alpha_head = torch.cholesky_solve(y_head, L_interpol)
+        alpha = torch.cat((alpha_head, alpha_tail), dim=1)
+        random_RKHS_norms = torch.sqrt(alpha.transpose(1, 2) @ kernel(X_c, X_c).evaluate() @ alpha).flatten()
+        list_random_RKHS_norms.append(random_RKHS_norms)
+    numpy_list = torch.cat(list_random_RKHS_norms).tolist()
+    numpy_list.sort()
+    return numpy_list
+
+
+@lru_cache(maxsize=None)
+def scenario_approach_index(m_PAC, gamma_PAC, kappa_PAC):
+    '''
+    Largest r < m_PAC with sum_{i<r} comb(m_PAC, i)*gamma_PAC**i*(1-gamma_PAC)**(m_PAC-i) <= kappa_PAC.
+    The binomial CDF is accumulated in log-space, so this also works for m_PAC in the tens of thousands,
+    and the result is memoized; it only depends on the PAC hyperparameters, not on the cube.
+    '''
+    i = np.arange(m_PAC)
+    log_pmf = gammaln(m_PAC + 1) - gammaln(i + 1) - gammaln(m_PAC - i + 1) + i*np.log(gamma_PAC) + (m_PAC - i)*np.log1p(-gamma_PAC)
+    log_cdf = np.logaddexp.accumulate(log_pmf)  # log_cdf[j] = log(sum_{i<=j})
+    num_admissible = np.count_nonzero(log_cdf <= np.log(kappa_PAC))  # the CDF is increasing, so these are the first entries
+    return int(min(num_admissible, m_PAC - 1))
+
+
+def scenario_approach_bound(B, sorted_norms, r_max):
+    # Algorithm 3: go down the sorted scenario norms until r_max or until B exceeds the r-th largest one
+    num_above = len(sorted_norms) - bisect.bisect_left(sorted_norms, B)  # first r with B > sorted_norms[-1-r]
+    r_final = min(r_max, max(num_above - 1, 0))
+    return max(B, sorted_norms[-1-r_final])
+
+
+if __name__ == '__main__':  # consistency check of the bound against the original loop of Algorithm 3, and of chunked against unchunked scenarios
+    import random
+    from math import comb
+    import gpytorch
+
+    def original_bound(B, sorted_norms, m_PAC, gamma_PAC, kappa_PAC):
+        r_final = 0
+        for r in range(m_PAC):
+            summ = sum(comb(m_PAC, i)*gamma_PAC**i*(1-gamma_PAC)**(m_PAC-i) for i in range(r))
+            if summ > kappa_PAC or B > sorted_norms[-1-r]:
+                break
+            r_final = r
+        return max(B, sorted_norms[-1-r_final])
+
+    m_PAC, gamma_PAC, kappa_PAC = 100, 0.1, 0.01
+    r_max = scenario_approach_index(m_PAC, gamma_PAC, kappa_PAC)
+    random.seed(0)
+    for _ in range(2000):
+        norms = sorted(random.random() for _ in range(m_PAC))
+        B = random.random()*1.05
+        assert scenario_approach_bound(B, norms, r_max) == original_bound(B, norms, m_PAC, gamma_PAC, kappa_PAC)
+    kernel = gpytorch.kernels.MaternKernel(nu=1.5)
+    kernel.lengthscale = 0.1
+    torch.manual_seed(0)
+    x_interpol = torch.rand(5, 1)
+    y_interpol = torch.rand(5)
+    with torch.no_grad():
+        torch.manual_seed(1)
+        sorted_norms = scenario_RKHS_norms(kernel, x_interpol, y_interpol, 0.0, 1.0, 50, m_PAC, 1)
+        torch.manual_seed(1)
+        sorted_norms_chunked = scenario_RKHS_norms(kernel, x_interpol, y_interpol, 0.0, 1.0, 50, m_PAC, 1, memory_budget=2**16)
+    assert max(abs(a - b) for a, b in zip(sorted_norms, sorted_norms_chunked)) <= 1e-4*max(sorted_norms)
+    print('PAC bounds agree with Algorithm 3.')
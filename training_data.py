@@ -0,0 +1,110 @@
+import os
+import numpy as np
+
+
+class sequence_store():
+    '''
+    Appendable on-disk storage of RNN training sequences. One record is the sequence of RKHS norms of the mean,
+    the sequence of reciprocal variance integrals (same length) and the local RKHS norm label of one cube.
+    values.f32 holds all sequences back to back, index.i64 holds (offset, length, group) per record and labels.f32 the labels.
+    commits.i64 holds (group, number of records) per appended group and is written last, so a group is either stored completely or not at all;
+    records after the last commit (e.g., after a crash in the middle of a group) are ignored and overwritten.
+    '''
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.mode = mode
+        if mode == 'a':
+            os.makedirs(path, exist_ok=True)
+            legacy = not os.path.exists(self.file('commits.i64')) and os.path.exists(self.file('index.i64'))
+            for name in ['values.f32', 'index.i64', 'labels.f32', 'commits.i64']:
+                open(os.path.join(path, name), 'ab').close()
+            if legacy:  # store without commits; every complete index entry counts as committed
+                self.commit_index()
+            self.repair()
+        self.refresh()
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def commit_index(self):
+        index = np.fromfile(self.file('index.i64'), dtype=np.int64)[:os.path.getsize(self.file('index.i64')) // (3*8)*3].reshape(-1, 3)
+        ends = [i + 1 for i in range(len(index)) if i + 1 == len(index) or index[i + 1, 2] != index[i, 2]]
+        with open(self.file('commits.i64'), 'ab') as handle:
+            handle.write(np.asarray([(index[end - 1, 2], end) for end in ends], dtype=np.int64).reshape(-1, 2).tobytes())
+
+    def num_committed(self, commits):
+        return int(commits[-1, 1]) if len(commits) > 0 else 0
+
+    def repair(self):  # cut everything that was written after the last complete commit
+        num_commits = os.path.getsize(self.file('commits.i64')) // (2*8)
+        with open(self.file('commits.i64'), 'r+b') as handle:
+            handle.truncate(num_commits*2*8)
+        num_records = self.num_committed(np.fromfile(self.file('commits.i64'), dtype=np.int64).reshape(-1, 2))
+        with open(self.file('index.i64'), 'r+b') as handle:
+            handle.truncate(num_records*3*8)
+        index = np.fromfile(self.file('index.i64'), dtype=np.int64).reshape(-1, 3)
+        num_values = int(index[-1, 0] + 2*index[-1, 1]) if num_records > 0 else 0
+        with open(self.file('values.f32'), 'r+b') as handle:
+            handle.truncate(num_values*4)
+        with open(self.file('labels.f32'), 'r+b') as handle:
+            handle.truncate(num_records*4)
+
+    def refresh(self):  # memory-map what is currently on disk
+        def memmap(name, dtype):
+            return np.memmap(self.file(name), dtype=dtype, mode='r') if os.path.getsize(self.file(name)) > 0 else np.zeros(0, dtype=dtype)
+        index = memmap('index.i64', np.int64)
+        index = index[:index.shape[0] // 3*3].reshape(-1, 3)
+        self.commits = None  # None for stores without commits; all their records count as committed
+        if os.path.exists(self.file('commits.i64')):  # a read-only view of a store that is being appended to only sees committed groups
+            commits = memmap('commits.i64', np.int64)
+            self.commits = commits[:commits.shape[0] // 2*2].reshape(-1, 2)
+            index = index[:self.num_committed(self.commits)]
+        self.index = index
+        self.values = memmap('values.f32', np.float32)
+        self.labels = memmap('labels.f32', np.float32)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, i):
+        offset, length, _ = self.index[i]
+        return self.values[offset:offset+length], self.values[offset+length:offset+2*length], self.labels[i]
+
+    def groups(self):  # also groups without records
+        return set(np.unique(self.index[:, 2] if self.commits is None else self.commits[:, 0]).tolist())
+
+    def append(self, list_training, group=-1):
+        # list_training as returned by run() in training mode: [RKHS norms of the mean, reciprocal variances, local RKHS norm] per cube
+        if self.mode != 'a':
+            raise Exception('Store is opened read-only.')
+        offset = os.path.getsize(self.file('values.f32')) // 4
+        values, index, labels = [], [], []
+        for mean_RKHS_norms, recip_variances, local_RKHS_norm in list_training:
+            length = len(mean_RKHS_norms)
+            values.append(np.asarray([float(v) for v in mean_RKHS_norms] + [float(v) for v in recip_variances], dtype=np.float32))
+            index.append((offset, length, group))
+            labels.append(float(local_RKHS_norm))
+            offset += 2*length
+        with open(self.file('values.f32'), 'ab') as handle:
+            handle.write(np.concatenate(values).tobytes() if values else b'')
+        with open(self.file('labels.f32'), 'ab') as handle:
+            handle.write(np.asarray(labels, dtype=np.float32).tobytes())
+        with open(self.file('index.i64'), 'ab') as handle:
+            handle.write(np.asarray(index, dtype=np.int64).reshape(-1, 3).tobytes())
+        with open(self.file('commits.i64'), 'ab') as handle:  # commit point of the group
+            handle.write(np.asarray([group, len(self) + len(index)], dtype=np.int64).tobytes())
+        self.refresh()
+
+    def batches(self, batch_size, pad_to=50, shuffle=False, seed=0):
+        # Zero-padded (batch_size x pad_to) inputs of both RNN branches and the labels, read lazily from the memory map
+        order = np.random.default_rng(seed).permutation(len(self)) if shuffle else np.arange(len(self))
+        for start in range(0, len(order), batch_size):
+            indices = order[start:start+batch_size]
+            input1 = np.zeros((len(indices), pad_to), dtype=np.float32)
+            input2 = np.zeros((len(indices), pad_to), dtype=np.float32)
+            for row, i in enumerate(indices):
+                mean_RKHS_norms, recip_variances, _ = self[i]
+                length = min(len(mean_RKHS_norms), pad_to)
+                input1[row, :length] = mean_RKHS_norms[:length]
+                input2[row, :length] = recip_variances[:length]
+            yield input1, input2, np.asarray(self.labels[indices])